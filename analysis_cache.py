@@ -0,0 +1,181 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+from image_formats import open_image
+
+CACHE_FILENAME = 'analysis_cache.sqlite3'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS analyses (
+    key TEXT PRIMARY KEY,
+    text TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS analyses_last_used ON analyses (last_used);
+CREATE TABLE IF NOT EXISTS outputs (
+    path TEXT PRIMARY KEY,
+    key TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pixel_hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT NOT NULL
+);
+"""
+
+
+def pixel_hash(image_path):
+    """SHA-256 of an image's decoded pixels, independent of file encoding and name."""
+    with open_image(image_path) as image:
+        digest = hashlib.sha256(f"{image.mode}|{image.size}|".encode('utf-8'))
+        digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def cache_key(pixel_digest, prompt, model_name):
+    digest = hashlib.sha256()
+    for part in (pixel_digest, prompt, model_name):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class AnalysisCache:
+    """
+    Content-addressed store of model analyses, shared by every folder.
+
+    Entries are keyed on the image's pixels, the prompt and the model, so an
+    identical image is only ever analysed once per prompt and model. The
+    least recently used entries are evicted once the stored text exceeds
+    max_bytes. The cache also records which key each analysis file on disk
+    was written for, so files from an older prompt are recognised as stale,
+    and the pixel hash of each image, so unchanged images are not decoded
+    again.
+
+    A read_only cache, as dry runs use, never creates or changes the
+    database: lookups read it if it exists, writes are ignored, and hits
+    and misses are not counted.
+    """
+
+    def __init__(self, db_path, max_bytes=256 * 1024 * 1024, read_only=False):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        if not read_only:
+            with self._connect() as conn:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.executescript(SCHEMA)
+
+    def _readable(self):
+        return not self.read_only or os.path.exists(self.db_path)
+
+    @contextmanager
+    def _connect(self):
+        if self.read_only:
+            conn = sqlite3.connect(f"file:{os.path.abspath(self.db_path)}?mode=ro", uri=True, timeout=30)
+        else:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key, count=True):
+        """
+        The cached analysis for key, or None. Each lookup counts as a hit or
+        a miss unless count is False, as for rechecks of a key that was
+        already looked up, so every image is counted once.
+        """
+        if self.read_only:
+            if not self._readable():
+                return None
+            with self._connect() as conn:
+                row = conn.execute('SELECT text FROM analyses WHERE key = ?', (key,)).fetchone()
+            return row[0] if row else None
+        with self._lock, self._connect() as conn:
+            row = conn.execute('SELECT text FROM analyses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                if count:
+                    self.misses += 1
+                    metrics.incr('analysis_cache.misses')
+                return None
+            conn.execute('UPDATE analyses SET last_used = ? WHERE key = ?', (time.time(), key))
+            if count:
+                self.hits += 1
+                metrics.incr('analysis_cache.hits')
+            return row[0]
+
+    def put(self, key, text):
+        if self.read_only:
+            return
+        size = len(text.encode('utf-8'))
+        with self._lock, self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO analyses VALUES (?, ?, ?, ?)', (key, text, size, time.time()))
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM analyses').fetchone()[0]
+            if total > self.max_bytes:
+                self._evict(conn, total)
+
+    def _evict(self, conn, total):
+        # Drop least recently used entries until 10% below the cap
+        target = self.max_bytes * 0.9
+        for key, size in conn.execute('SELECT key, size FROM analyses ORDER BY last_used').fetchall():
+            if total <= target:
+                break
+            conn.execute('DELETE FROM analyses WHERE key = ?', (key,))
+            total -= size
+            self.evictions += 1
+
+    def pixel_hash(self, image_path):
+        """pixel_hash() of an image, remembered until its size or mtime changes."""
+        path = os.path.abspath(image_path)
+        stat = os.stat(path)
+        if self._readable():
+            try:
+                with self._connect() as conn:
+                    row = conn.execute('SELECT digest FROM pixel_hashes WHERE path = ? AND size = ? AND mtime_ns = ?',
+                                       (path, stat.st_size, stat.st_mtime_ns)).fetchone()
+            except sqlite3.OperationalError:
+                # Read-only look at a cache written before pixel hashes were kept
+                row = None
+            if row is not None:
+                return row[0]
+        digest = pixel_hash(path)
+        if self.read_only:
+            return digest
+        with self._lock, self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO pixel_hashes VALUES (?, ?, ?, ?)',
+                         (path, stat.st_size, stat.st_mtime_ns, digest))
+        return digest
+
+    def output_key(self, path):
+        """The key the analysis file at path was written for, if known."""
+        if not self._readable():
+            return None
+        with self._connect() as conn:
+            row = conn.execute('SELECT key FROM outputs WHERE path = ?', (path,)).fetchone()
+        return row[0] if row else None
+
+    def record_output(self, path, key):
+        if self.read_only:
+            return
+        with self._lock, self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO outputs VALUES (?, ?)', (path, key))
+
+    def stats(self):
+        entries, size = 0, 0
+        if self._readable():
+            with self._connect() as conn:
+                entries, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM analyses').fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': entries, 'bytes': size}
@@ -0,0 +1,192 @@
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# HTTP statuses and SDK exception names worth retrying
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+TRANSIENT_ERROR_NAMES = {
+    'DeadlineExceeded',
+    'InternalServerError',
+    'ResourceExhausted',
+    'ServiceUnavailable',
+    'TooManyRequests',
+}
+
+# Rough cost of one image in a Gemini request, used until real usage is known
+IMAGE_TOKEN_ESTIMATE = 258
+
+
+def estimate_tokens(prompt, images=1):
+    return len(prompt) // 4 + images * IMAGE_TOKEN_ESTIMATE
+
+
+def is_transient(error):
+    """True for rate limiting, timeouts and server-side errors."""
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    if type(error).__name__ in TRANSIENT_ERROR_NAMES:
+        return True
+    for attribute in ('code', 'status_code'):
+        code = getattr(error, attribute, None)
+        code = code() if callable(code) else code
+        if isinstance(code, int) and code in TRANSIENT_STATUS_CODES:
+            return True
+    return False
+
+
+class RateLimiter:
+    """
+    Sliding one-minute window over requests and tokens. acquire() blocks
+    until a request of the given token cost fits in both budgets.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, clock=time.monotonic, sleep=time.sleep):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._clock = clock
+        self._sleep = sleep
+        self._window = deque()  # (timestamp, tokens)
+        self._tokens = 0
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while self._window and now - self._window[0][0] >= 60:
+            self._tokens -= self._window.popleft()[1]
+
+    def acquire(self, tokens=0):
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._expire(now)
+                requests_ok = not self.requests_per_minute or len(self._window) < self.requests_per_minute
+                # A single request larger than the whole budget is let through on an empty window
+                tokens_ok = (not self.tokens_per_minute or not self._window
+                             or self._tokens + tokens <= self.tokens_per_minute)
+                if requests_ok and tokens_ok:
+                    self._window.append((now, tokens))
+                    self._tokens += tokens
+                    return
+                wait = 60 - (now - self._window[0][0])
+            self._sleep(max(wait, 0.01))
+
+    def adjust(self, estimated, actual):
+        """Replaces an estimated token cost with the real usage once known."""
+        with self._lock:
+            for index in range(len(self._window) - 1, -1, -1):
+                timestamp, tokens = self._window[index]
+                if tokens == estimated:
+                    self._window[index] = (timestamp, actual)
+                    self._tokens += actual - estimated
+                    return
+
+
+class AnalysisScheduler:
+    """
+    Runs analysis tasks concurrently within a request and token budget.
+
+    Each task is a JSON-serialisable dict with a unique 'output' path. The
+    handler receives the task, does one model call and returns the number of
+    tokens it used (or None if unknown). Transient errors are retried with
+    exponential backoff and full jitter; anything else fails the task.
+
+    Pending tasks are kept in queue_path, so an interrupted run picks up
+    where it stopped and failed tasks are retried on the next run.
+    """
+
+    def __init__(self, handler, workers=4, requests_per_minute=None, tokens_per_minute=None,
+                 max_retries=5, base_delay=2.0, max_delay=60.0, queue_path=None, sleep=time.sleep):
+        self.handler = handler
+        self.workers = workers
+        self.limiter = RateLimiter(requests_per_minute, tokens_per_minute, sleep=sleep)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.queue_path = queue_path
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._pending = {}
+        self._last_save = 0
+        self.stats = {'done': 0, 'failed': 0, 'retries': 0, 'tokens': 0}
+        if queue_path and os.path.exists(queue_path):
+            try:
+                with open(queue_path, 'r', encoding='utf-8') as f:
+                    for task in json.load(f):
+                        self._pending[task['output']] = task
+                print(f"DEBUG: Resuming {len(self._pending)} pending analysis tasks from {queue_path}")
+            except Exception as e:
+                print(f"DEBUG: Error reading analysis queue {queue_path}: {e}")
+
+    def submit(self, task):
+        with self._lock:
+            self._pending.setdefault(task['output'], task)
+
+    @property
+    def pending(self):
+        with self._lock:
+            return list(self._pending.values())
+
+    def _save(self, force=True):
+        # Progress is checkpointed every few seconds rather than per task
+        if not self.queue_path or (not force and time.monotonic() - self._last_save < 2):
+            return
+        with self._save_lock:
+            with self._lock:
+                self._last_save = time.monotonic()
+                tasks = list(self._pending.values())
+            if not tasks:
+                if os.path.exists(self.queue_path):
+                    os.remove(self.queue_path)
+                return
+            temp_path = f"{self.queue_path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(tasks, f)
+            os.replace(temp_path, self.queue_path)
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _run_task(self, task):
+        estimated = task.get('tokens') or estimate_tokens(task.get('prompt', ''))
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire(estimated)
+            try:
+                used = self.handler(task)
+            except Exception as e:
+                if attempt < self.max_retries and is_transient(e):
+                    delay = self._backoff(attempt)
+                    print(f"DEBUG: Transient error on {task['output']} ({e}), retrying in {delay:.1f}s")
+                    with self._lock:
+                        self.stats['retries'] += 1
+                    self._sleep(delay)
+                    continue
+                print(f"DEBUG: Error processing {task['output']}: {e}")
+                with self._lock:
+                    self.stats['failed'] += 1
+                return False
+
+            if used:
+                self.limiter.adjust(estimated, used)
+            with self._lock:
+                self.stats['done'] += 1
+                self.stats['tokens'] += used or estimated
+                self._pending.pop(task['output'], None)
+            self._save(force=False)
+            return True
+        return False
+
+    def run(self):
+        """Processes every pending task and returns the run's stats."""
+        tasks = self.pending
+        self._save()
+        if tasks:
+            try:
+                with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                    list(pool.map(self._run_task, tasks))
+            finally:
+                self._save()
+        return dict(self.stats)
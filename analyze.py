@@ -1,46 +1,50 @@
+import argparse
 import os
-import time
+from concurrent.futures import ThreadPoolExecutor
 
 import chardet
-import google.generativeai as genai
-import openai
-from fpdf import FPDF
-from PIL import Image
 
-# --- API Keys ---
+import metrics
+from analysis_scheduler import AnalysisScheduler, estimate_tokens
+from backends import BACKENDS, GeminiBackend, create_backend
+from build_manifest import BuildManifest
 
+# The Gemini SDK, numpy/Pillow, fpdf2 and the catalog are imported by the stages that use
+# them, so importing this module, or a report-only run, stays cheap.
 
-GOOGLE_API_KEY = "API_KEY"
+DEFAULT_IMAGE_DIR = "extracted_images"
+DEFAULT_MODEL_NAME = 'gemini-2.0-flash'
 
+# Per-image analysis runs this many requests in parallel, within the API quota
+ANALYSIS_WORKERS = 4
+REQUESTS_PER_MINUTE = 15
+TOKENS_PER_MINUTE = 1_000_000
 
-genai.configure(api_key=GOOGLE_API_KEY)
+# Responses of the record and replay backends are kept here, next to the images folder
+DEFAULT_RESPONSES_DIR = "model_responses"
 
+# Neighbouring slices that differ by less than this (mean absolute pixel
+# difference, 0-1) share one analysis; 0 analyses every slice
+KEY_SLICE_THRESHOLD = 0.02
 
-openai.api_key = "API_KEY"
+# Up to this many slices of one series go in a single request, downscaled
+# and re-encoded so the request stays under BATCH_MAX_BYTES
+BATCH_MAX_IMAGES = 8
+BATCH_MAX_BYTES = 4 * 1024 * 1024
+PAYLOAD_MAX_EDGE = 1024
+PAYLOAD_QUALITY = 85
 
+# Analyses shared across every series and patient, keyed on pixels, prompt and model
+ANALYSIS_CACHE_BYTES = 256 * 1024 * 1024
 
-main_image_dir = os.path.join(os.getcwd(), "extracted_images", "")
+#SYMPTOMS = "Patient symptoms experienced: Right side of body numb."
+SYMPTOMS = ""
 
-# Define model_name BEFORE using it
-model_name = 'gemini-2.0-flash'
+# Folder reports are rendered by this many processes (None: one per CPU)
+REPORT_WORKERS = None
 
-combined_pdf_file_path = os.path.join(main_image_dir, f"combined_summary_{model_name.replace('-', '_')}.pdf")
-combined_analysis_file_path = os.path.join(main_image_dir, f"combined_analysis_{model_name.replace('-', '_')}.txt")
-final_summary_path_txt = os.path.join(main_image_dir, f"summary_{model_name.replace('-', '_')}.txt")
-
-
-model = genai.GenerativeModel(model_name)
-
-
-#symptoms = "Patient symptoms experienced: Right side of body numb."
-symptoms = ""
-
-combined_summary_content = ""
-all_combined_analysis_content = ""
-
-
-# Define font paths (adjust these based on where the TTF files are)
-unicode_font_path = 'NotoSans-Regular.ttf'  # Using Noto Sans as a Unicode font
+# Bump when the PDF layout changes so every report is re-rendered
+REPORT_VERSION = '2'
 
 
 def read_file_with_fallback(path):
@@ -51,241 +55,557 @@ def read_file_with_fallback(path):
     return raw_data.decode(encoding, errors='replace')
 
 
-def process_and_save_image(filepath, folder_path):
-    filename = os.path.basename(filepath)
-    output_filename = os.path.join(folder_path, f"{os.path.splitext(filename)[0]}_analysis_{model_name.replace('-', '_')}.txt")
-
-    if os.path.exists(output_filename) and os.path.getsize(output_filename) > 0:
-        print(f"DEBUG: Analysis file already exists and is not blank for {filename} in {os.path.basename(folder_path)}. Skipping.")
-        return
-
-    try:
-        img = Image.open(filepath)
-        prompt = f"Analyze this medical image for any visible abnormalities, asymmetries, or deviations from expected anatomy. Describe any findings that might suggest a potential medical issue, keeping in mind that further clinical correlation is necessary for diagnosis. Do not give any disclaimers. Give a probability of correctness. {symptoms} {filename} in {os.path.basename(folder_path)}"
-        response = model.generate_content([prompt, img])
-        analysis_text = response.text
-        print(f"--- Analysis for {filename} in {os.path.basename(folder_path)} ---")
+def image_prompt(symptoms=SYMPTOMS):
+    """The per-image prompt shared by every image, which analyses are cached under."""
+    return f"Analyze this medical image for any visible abnormalities, asymmetries, or deviations from expected anatomy. Describe any findings that might suggest a potential medical issue, keeping in mind that further clinical correlation is necessary for diagnosis. Do not give any disclaimers. Give a probability of correctness. {symptoms}"
+
+
+def summary_prompt(analysis_content):
+    return f"Synthesize the key observations derived from the provided medical image analysis. Clearly highlight any identified abnormalities, precisely specify their locations within the image(s), and articulate the potential clinical implications of these findings using clear and concise language. Ensure that each abnormality and its associated details are presented distinctly. Give a probability for each. Do not give any disclaimers. :\n\n{analysis_content}"
+
+
+def aggregate_prompt(summary_content):
+    return f"Analyze the provided medical summaries and synthesize the key observations. Identify and describe all abnormalities with precise anatomical locations, and explain the potential clinical implications of each finding in clear, concise language. Present each abnormality separately, assigning a probability to each. Avoid any disclaimers or use of tables. :\n\n{summary_content}"
+
+
+class AnalysisPipeline:
+    """
+    Analyses the extracted images under a root folder and builds the
+    summaries and PDF reports from the analyses.
+
+    The work is split in three stages that can run separately:
+
+    - analyse: one analysis per key slice, sent to the model concurrently
+    - summarise: a summary per series folder, the combined analysis and
+      summary files, and the model's analysis of the combined summary
+    - report: the PDF reports of the folder summaries and of the combined
+      summary
+
+    Creating a pipeline has no side effects; the model, catalog and caches
+    are set up by the first stage that needs them. With dry_run, the stages
+    only report what they would do: nothing is sent to the model or written.
+
+    Requests go to backend (see backends.py), by default the Gemini API.
+    """
+
+    def __init__(self, root=DEFAULT_IMAGE_DIR, model_name=DEFAULT_MODEL_NAME, workers=ANALYSIS_WORKERS,
+                 dry_run=False, api_key=None, symptoms=SYMPTOMS, font_path=None, backend=None,
+                 requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE):
+        self.root = os.path.join(os.path.abspath(root), "")
+        self.model_name = model_name
+        self.workers = workers
+        self.dry_run = dry_run
+        self.api_key = api_key
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.symptoms = symptoms
+        self.font_path = font_path
+
+        suffix = model_name.replace('-', '_')
+        self.analysis_suffix = f"_analysis_{suffix}.txt"
+        self.summary_filename = f"summary_{suffix}.txt"
+        self.summary_pdf_filename = f"summary_{suffix}.pdf"
+        self.combined_pdf_path = os.path.join(self.root, f"combined_summary_{suffix}.pdf")
+        self.combined_analysis_path = os.path.join(self.root, f"combined_analysis_{suffix}.txt")
+        self.final_summary_path = os.path.join(self.root, self.summary_filename)
+        self.summary_analysis_path = os.path.join(self.root, f"analysis_of_summary_{suffix}.txt")
+        self.queue_path = os.path.join(self.root, f"analysis_queue_{suffix}.json")
+        self.manifest_path = os.path.join(self.root, f"build_manifest_{suffix}.json")
+
+        self._backend = backend
+        self._catalog = None
+        self._analysis_cache = None
+        self._manifest = None
+        self._scheduler = None
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = GeminiBackend(self.model_name, self.api_key)
+        return self._backend
+
+    @property
+    def catalog(self):
+        # Keep the web app's folder catalog in step with the summaries written here
+        if self._catalog is None:
+            from catalog import Catalog, default_catalog_path
+
+            self._catalog = Catalog(default_catalog_path(self.root), self.root)
+        return self._catalog
+
+    @property
+    def analysis_cache(self):
+        if self._analysis_cache is None:
+            from analysis_cache import CACHE_FILENAME, AnalysisCache
+
+            self._analysis_cache = AnalysisCache(
+                os.path.join(os.path.dirname(os.path.normpath(self.root)), CACHE_FILENAME),
+                max_bytes=ANALYSIS_CACHE_BYTES,
+                # A dry run looks up what is cached but must not create or change the cache
+                read_only=self.dry_run,
+            )
+        return self._analysis_cache
+
+    @property
+    def manifest(self):
+        # Outputs are only rebuilt when the fingerprint of their inputs
+        # (input file hashes, prompt, model) differs from the recorded one
+        if self._manifest is None:
+            self._manifest = BuildManifest(self.manifest_path)
+        return self._manifest
+
+    def save_manifest(self):
+        if self._manifest is not None and not self.dry_run:
+            self._manifest.save()
+
+    # --- Per-image analysis ---
+
+    def analysis_output_path(self, filepath):
+        folder_path, filename = os.path.split(filepath)
+        return os.path.join(folder_path, f"{os.path.splitext(filename)[0]}{self.analysis_suffix}")
+
+    def write_analysis(self, output_filename, analysis_text, key):
+        with open(output_filename, 'w') as outfile:
+            outfile.write(analysis_text)
+        self.analysis_cache.record_output(output_filename, key)
+
+    def image_analysis_task(self, filepath):
+        """
+        Returns the scheduler task for an image, or None if it needs no model call:
+        its analysis is up to date, or an identical image was already analysed
+        with the same prompt and model.
+        """
+        from analysis_cache import cache_key
+        from request_batching import prepare_image
+
+        folder_path, filename = os.path.split(filepath)
+        output_filename = self.analysis_output_path(filepath)
+        prompt = image_prompt(self.symptoms)
+        key = cache_key(self.analysis_cache.pixel_hash(filepath), prompt, self.model_name)
+
+        if os.path.exists(output_filename) and os.path.getsize(output_filename) > 0:
+            recorded_key = self.analysis_cache.output_key(output_filename)
+            if recorded_key is None:
+                # Written before the cache existed: adopt it for the current prompt
+                if not self.dry_run:
+                    self.analysis_cache.put(key, read_file_with_fallback(output_filename))
+                    self.analysis_cache.record_output(output_filename, key)
+                return None
+            if recorded_key == key:
+                return None
+            print(f"DEBUG: Analysis for {filename} in {os.path.basename(folder_path)} was made with another prompt or model.")
+
+        cached_text = self.analysis_cache.get(key)
+        if cached_text is not None:
+            if not self.dry_run:
+                self.write_analysis(output_filename, cached_text, key)
+                print(f"DEBUG: Reused cached analysis for {filename} in {os.path.basename(folder_path)}.")
+            return None
+
+        prompt = f"{prompt} {filename} in {os.path.basename(folder_path)}"
+        # Batches are packed on the size of the JPEG that will actually be uploaded
+        payload_bytes = len(prepare_image(filepath, PAYLOAD_MAX_EDGE, PAYLOAD_QUALITY)['data'])
+        return {'image': filepath, 'output': output_filename, 'prompt': prompt, 'key': key,
+                'tokens': estimate_tokens(prompt), 'payload_bytes': payload_bytes}
+
+    def already_analysed(self, task):
+        """True if the task's analysis was written, or can be copied from the cache, since it was queued."""
+        filename = os.path.basename(task['image'])
+        folder_name = os.path.basename(os.path.dirname(task['image']))
+        # A resumed queue may hold images analysed since it was written
+        if self.analysis_cache.output_key(task['output']) == task['key'] and os.path.exists(task['output']):
+            print(f"DEBUG: Analysis file already exists and is not blank for {filename} in {folder_name}. Skipping.")
+            return True
+        # An identical image queued in the same run may have been analysed meanwhile; the
+        # key was already counted when the task was queued
+        cached_text = self.analysis_cache.get(task['key'], count=False)
+        if cached_text is not None:
+            self.write_analysis(task['output'], cached_text, task['key'])
+            return True
+        return False
+
+    def save_analysis(self, task, analysis_text):
+        filename = os.path.basename(task['image'])
+        print(f"--- Analysis for {filename} in {os.path.basename(os.path.dirname(task['image']))} ---")
         print(analysis_text)
         print("\n")
-
-        try:
-            with open(output_filename, 'w') as outfile:
-                outfile.write(analysis_text)
-            print(f"Analysis for {filename} saved to: {output_filename}\n")
-        except Exception as e:
-            print(f"DEBUG: Error saving analysis for {filename} to {output_filename}: {e}\n")
-
-    except Exception as e:
-        print(f"DEBUG: Error processing {filename} in {os.path.basename(folder_path)}: {e}")
-        time.sleep(10)
-
-
-# Initialize the combined analysis file at the beginning to ensure overwriting
-try:
-    with open(combined_analysis_file_path, 'w', encoding='utf-8') as outfile:
-        outfile.write("")
-    print(f"DEBUG: Initialized (overwrote if existing) combined analysis file at: {combined_analysis_file_path}")
-except Exception as e:
-    print(f"DEBUG: Error initializing combined analysis file: {e}")
-
-# Initialize the final summary file at the beginning to ensure overwriting
-try:
-    with open(final_summary_path_txt, 'w', encoding='utf-8') as outfile:
-        outfile.write("")
-    print(f"DEBUG: Initialized (overwrote if existing) final summary file at: {final_summary_path_txt}")
-    combined_summary_content = "" # Reset the in-memory content as well
-except Exception as e:
-    print(f"DEBUG: Error initializing final summary file: {e}")
-
-
-for root, _, files in os.walk(main_image_dir, topdown=False):
-    print(f"DEBUG: Processing folder: {root}")
-
-    all_analysis_files = [
-        f for f in os.listdir(root)
-        if f.endswith(f"_analysis_{model_name.replace('-', '_')}.txt")
-    ]
-    if all_analysis_files:
-        for analysis_file in all_analysis_files:
-            analysis_file_path = os.path.join(root, analysis_file)
-            try:
-                content = read_file_with_fallback(analysis_file_path)
-                all_combined_analysis_content += f"--- Content from: {os.path.basename(root)}/{analysis_file} ---\n{content}\n\n--------------------\n\n"
-                print(f"DEBUG: Combined content of {analysis_file} from {os.path.basename(root)}.")
-            except Exception as e:
-                print(f"DEBUG: Error reading {analysis_file}: {e}")
-
-        summary_output_path = os.path.join(root, f"summary_{model_name.replace('-', '_')}.txt")
-        pdf_output_path = os.path.join(root, f"summary_{model_name.replace('-', '_')}.pdf")
-
-        if os.path.exists(summary_output_path) and os.path.getsize(summary_output_path) > 0:
-            print(f"DEBUG: Summary file exists at {summary_output_path}. Proceeding with PDF creation/recreation.")
+        self.analysis_cache.put(task['key'], analysis_text)
+        self.write_analysis(task['output'], analysis_text, task['key'])
+        print(f"Analysis for {filename} saved to: {task['output']}\n")
+
+    def process_and_save_batch(self, batch):
+        """
+        Scheduler handler: analyses a batch of images from one folder in a single
+        request and saves each image's analysis next to it. Images the model
+        leaves out of its answer are retried one per request. Errors propagate
+        so the scheduler can retry transient failures.
+        """
+        from request_batching import batch_prompt, prepare_image, split_batch_response
+
+        tasks = [task for task in batch.get('items', [batch]) if not self.already_analysed(task)]
+        if not tasks:
+            return 0
+        payloads = [prepare_image(task['image'], PAYLOAD_MAX_EDGE, PAYLOAD_QUALITY) for task in tasks]
+
+        if len(tasks) == 1:
+            analysis_text, tokens = self.backend.analyse(tasks[0]['prompt'], payloads)
+            self.save_analysis(tasks[0], analysis_text)
+            return tokens
+
+        labels = [f"{os.path.basename(task['image'])} in {os.path.basename(os.path.dirname(task['image']))}" for task in tasks]
+        analysis_text, tokens = self.backend.analyse(batch_prompt(image_prompt(self.symptoms), labels), payloads)
+        sections = split_batch_response(analysis_text, len(tasks))
+        for number, (task, payload) in enumerate(zip(tasks, payloads), start=1):
+            if number in sections:
+                self.save_analysis(task, sections[number])
+            else:
+                print(f"DEBUG: Batched response had no section for {labels[number - 1]}, requesting it alone.")
+                self._scheduler.limiter.acquire(task['tokens'])
+                single_text, single_tokens = self.backend.analyse(task['prompt'], [payload])
+                self.save_analysis(task, single_text)
+                tokens += single_tokens
+        return tokens
+
+    def analyse(self):
+        """
+        Analyses every key slice that has no up-to-date analysis yet, across
+        the whole archive. Returns the scheduler's stats.
+        """
+        from image_formats import slice_files
+        from key_slices import select_key_slices
+        from request_batching import pack_batches
+
+        # Only one representative of each run of near-identical slices is analysed
+        image_paths = []
+        for root, _, files in os.walk(self.root):
+            image_files = slice_files(files)
+            if not image_files:
+                continue
             try:
-                text_content = read_file_with_fallback(summary_output_path)
-                combined_summary_content += f"\n--- Summary for {os.path.basename(root)} ---\n{text_content}\n"
+                coverage = select_key_slices(root, image_files, KEY_SLICE_THRESHOLD, record=not self.dry_run)
             except Exception as e:
-                print(f"DEBUG: Error reading summary file: {e}")
-
-            # Create PDF
-            pdf = FPDF()
-            pdf.add_page()
+                print(f"DEBUG: Error selecting key slices in {os.path.basename(root)}: {e}")
+                coverage = {file: [file] for file in image_files}
+            print(f"DEBUG: {len(coverage)} of {len(image_files)} slices selected for analysis in {os.path.basename(root)}.")
+            image_paths.extend(os.path.join(root, file) for file in coverage)
+        # Hashing pixels and sizing payloads decode images, so spread it over the same number of threads
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            image_tasks = [task for task in pool.map(self.image_analysis_task, image_paths) if task is not None]
+        # Several slices of a series share one request
+        batches = pack_batches(image_tasks, BATCH_MAX_IMAGES, BATCH_MAX_BYTES)
+        if self.dry_run:
+            print(f"DEBUG: Dry run: {len(image_tasks)} images would be analysed in {len(batches)} requests.")
+            return {'done': 0, 'failed': 0, 'retries': 0, 'tokens': 0}
+
+        self._scheduler = AnalysisScheduler(
+            self.process_and_save_batch,
+            workers=self.workers,
+            requests_per_minute=self.requests_per_minute,
+            tokens_per_minute=self.tokens_per_minute,
+            queue_path=self.queue_path,
+        )
+        for batch in batches:
+            self._scheduler.submit({
+                'output': batch[0]['output'],
+                'items': batch,
+                'tokens': estimate_tokens(image_prompt(self.symptoms), images=len(batch)) + 20 * len(batch),
+            })
+        print(f"DEBUG: {len(image_tasks)} images queued for analysis in {len(self._scheduler.pending)} requests.")
+        analysis_stats = self._scheduler.run()
+        print(f"DEBUG: Image analysis finished: {analysis_stats}")
+        print(f"DEBUG: Analysis cache: {self.analysis_cache.stats()}")
+        return analysis_stats
+
+    # --- Summaries ---
+
+    def analysed_folders(self):
+        """(folder, analysis filenames) for every series folder with analyses, sorted."""
+        analysed_folders = []
+        for root, _, files in os.walk(self.root):
+            # The top level holds the combined outputs, whose names match the per-folder ones
+            if os.path.normpath(root) == os.path.normpath(self.root):
+                continue
+            analysis_files = sorted(f for f in files if f.endswith(self.analysis_suffix))
+            if analysis_files:
+                analysed_folders.append((root, analysis_files))
+        analysed_folders.sort()
+        return analysed_folders
+
+    def summarise_folder(self, root, analysis_files):
+        """Returns the folder's summary path, or None if it has no summary."""
+        print(f"DEBUG: Processing folder: {root}")
+        analysis_paths = [os.path.join(root, f) for f in analysis_files]
+        summary_output_path = os.path.join(root, self.summary_filename)
+
+        summary_fingerprint = self.manifest.fingerprint(analysis_paths, [summary_prompt(''), self.model_name])
+        if self.manifest.is_current(summary_output_path, summary_fingerprint):
+            print(f"DEBUG: Summary at {summary_output_path} is up to date.")
+            return summary_output_path
+        if self.manifest.adopt(summary_output_path, summary_fingerprint):
+            print(f"DEBUG: Summary file exists at {summary_output_path}. Keeping it.")
+            return summary_output_path
+        if self.dry_run:
+            print(f"DEBUG: Dry run: would generate summary for {os.path.basename(root)}.")
+            return summary_output_path if os.path.exists(summary_output_path) else None
+
+        analysis_contents = []
+        for af_path in analysis_paths:
             try:
-                pdf.add_font('NotoSans', '', unicode_font_path)
-                pdf.set_font('NotoSans', '', 8)
+                analysis_contents.append(read_file_with_fallback(af_path) + "\n\n--------------------\n\n")
             except Exception as e:
-                print(f"DEBUG: Error loading Unicode font: {e}")
-                pdf.set_font("Helvetica", size=8)
-
-            lines = text_content.split('\n')
-            line_height = pdf.font_size * 1.5
+                print(f"DEBUG: Error reading {os.path.basename(af_path)} for summary generation: {e}")
+        analysis_content_for_summary = "".join(analysis_contents)
 
-            for line in lines:
-                if line.strip():
+        try:
+            print(f"DEBUG: Generating {self.backend.name} summary for: {os.path.basename(root)}")
+            summary_text, _ = self.backend.summarise(summary_prompt(analysis_content_for_summary))
+            with open(summary_output_path, 'w') as outfile_summary:
+                outfile_summary.write(summary_text)
+            self.manifest.record(summary_output_path, summary_fingerprint)
+            print(f"DEBUG: Generated summary and saved to: {summary_output_path}\n")
+            self.catalog.refresh_folder(root)
+        except Exception as e:
+            print(f"DEBUG: Error generating or saving summary: {e}\n")
+            return None
+        return summary_output_path
+
+    def write_combined_analysis(self, analysed_folders):
+        """Combined analysis of every folder, rebuilt when any analysis file or slice coverage changes."""
+        from key_slices import KEY_SLICES_FILENAME, read_key_slices
+
+        coverage_paths = [path for path in (os.path.join(root, KEY_SLICES_FILENAME) for root, _ in analysed_folders) if os.path.exists(path)]
+        fingerprint = self.manifest.fingerprint(
+            [os.path.join(root, f) for root, files in analysed_folders for f in files] + coverage_paths,
+            [root for root, _ in analysed_folders],
+        )
+        if self.manifest.is_current(self.combined_analysis_path, fingerprint):
+            print(f"DEBUG: Combined analysis file is up to date: {self.combined_analysis_path}")
+            return
+        if self.dry_run:
+            print(f"DEBUG: Dry run: would write combined analysis file: {self.combined_analysis_path}")
+            return
+        # Streamed straight to disk, one analysis file at a time
+        try:
+            with open(f"{self.combined_analysis_path}.tmp", 'w', encoding='utf-8') as outfile:
+                for root, all_analysis_files in analysed_folders:
+                    coverage = {os.path.splitext(name)[0]: covered for name, covered in read_key_slices(root).items()}
+                    for analysis_file in all_analysis_files:
+                        try:
+                            content = read_file_with_fallback(os.path.join(root, analysis_file))
+                        except Exception as e:
+                            print(f"DEBUG: Error reading {analysis_file}: {e}")
+                            continue
+                        covered = coverage.get(analysis_file.split('_analysis_')[0], [])
+                        covers = f" (covers {covered[0]} to {covered[-1]})" if len(covered) > 1 else ""
+                        outfile.write(f"--- Content from: {os.path.basename(root)}/{analysis_file}{covers} ---\n{content}\n\n--------------------\n\n")
+                        print(f"DEBUG: Combined content of {analysis_file} from {os.path.basename(root)}.")
+            os.replace(f"{self.combined_analysis_path}.tmp", self.combined_analysis_path)
+            self.manifest.record(self.combined_analysis_path, fingerprint)
+            print(f"DEBUG: Successfully created combined analysis file at: {self.combined_analysis_path}")
+        except Exception as e:
+            print(f"DEBUG: Error writing to combined analysis file: {e}")
+
+    def write_final_summary(self, summary_paths):
+        """Combined summary text, rebuilt when any folder summary changes."""
+        fingerprint = self.manifest.fingerprint([path for _, path in summary_paths], [root for root, _ in summary_paths])
+        if self.manifest.is_current(self.final_summary_path, fingerprint):
+            print(f"DEBUG: Combined summary is up to date: {self.final_summary_path}")
+            return
+        if self.dry_run:
+            print(f"DEBUG: Dry run: would write combined summary: {self.final_summary_path}")
+            return
+        # Streamed straight to disk, one folder summary at a time
+        try:
+            with open(f"{self.final_summary_path}.tmp", 'w', encoding='utf-8') as final_summary_file:
+                for root, summary_output_path in summary_paths:
                     try:
-                        pdf.cell(0, line_height, line, ln=1, align='L')
+                        text_content = read_file_with_fallback(summary_output_path)
                     except Exception as e:
-                        encoded_line = line.encode('latin-1', 'ignore').decode('latin-1')
-                        pdf.cell(0, line_height, encoded_line, ln=1, align='L')
-
-            pdf.output(pdf_output_path, 'F')
-            print(f"DEBUG: Successfully created/recreated PDF summary: '{pdf_output_path}'")
+                        print(f"DEBUG: Error reading summary file: {e}")
+                        continue
+                    final_summary_file.write(f"\n--- Summary for {os.path.basename(root)} ---\n{text_content}\n")
+            os.replace(f"{self.final_summary_path}.tmp", self.final_summary_path)
+            self.manifest.record(self.final_summary_path, fingerprint)
+            print(f"DEBUG: Successfully wrote combined summary content to: {self.final_summary_path}")
+        except Exception as e:
+            print(f"DEBUG: Error writing combined summary: {e}")
 
+    def analyse_final_summary(self):
+        """The model's analysis of the combined summary, rebuilt when the summary changes."""
+        try:
+            fingerprint = self.manifest.fingerprint([self.final_summary_path], [aggregate_prompt(''), self.model_name])
+            if self.manifest.is_current(self.summary_analysis_path, fingerprint):
+                print(f"DEBUG: Analysis of the final summary is up to date: {self.summary_analysis_path}")
+                return
+            if self.dry_run:
+                print(f"DEBUG: Dry run: would analyse the final summary into: {self.summary_analysis_path}")
+                return
+            with open(self.final_summary_path, 'r', encoding='utf-8') as f:
+                summary_content = f.read()
+
+            analysis_result, _ = self.backend.aggregate(aggregate_prompt(summary_content))
+
+            with open(self.summary_analysis_path, 'w', encoding='utf-8') as outfile:
+                outfile.write(analysis_result)
+            self.manifest.record(self.summary_analysis_path, fingerprint)
+            print(f"\nThe {self.backend.name} analysis of the final summary saved to: {self.summary_analysis_path}")
+
+        except FileNotFoundError:
+            print(f"Error: Final summary file not found at: {self.final_summary_path}")
+        except Exception as e:
+            print(f"An error occurred during the analysis request: {e}")
+
+    def summarise(self):
+        """Writes the folder summaries, the combined files and the analysis of the combined summary."""
+        analysed_folders = self.analysed_folders()
+        summary_paths = []
+        for root, analysis_files in analysed_folders:
+            summary_output_path = self.summarise_folder(root, analysis_files)
+            if summary_output_path:
+                summary_paths.append((root, summary_output_path))
+        self.save_manifest()
+
+        self.write_combined_analysis(analysed_folders)
+        self.write_final_summary(summary_paths)
+        self.save_manifest()
+
+        self.analyse_final_summary()
+        self.save_manifest()
+        return summary_paths
+
+    # --- Reports ---
+
+    def report(self):
+        """Renders the PDF reports of the folder summaries and of the combined summary."""
+        from reports import DEFAULT_FONT_PATH, ReportRenderer, render_reports
+
+        font_path = self.font_path or DEFAULT_FONT_PATH
+        pdf_jobs = []
+        for root, _ in self.analysed_folders():
+            summary_output_path = os.path.join(root, self.summary_filename)
+            if not os.path.exists(summary_output_path):
+                continue
+            pdf_output_path = os.path.join(root, self.summary_pdf_filename)
+            pdf_fingerprint = self.manifest.fingerprint([summary_output_path], [REPORT_VERSION])
+            if not self.manifest.is_current(pdf_output_path, pdf_fingerprint):
+                pdf_jobs.append((summary_output_path, pdf_output_path, pdf_fingerprint))
+
+        if self.dry_run:
+            for _, pdf_output_path, _ in pdf_jobs:
+                print(f"DEBUG: Dry run: would render PDF summary: '{pdf_output_path}'")
         else:
-            # Generate summary only if there were analysis files in this directory
-            if all_analysis_files:
-                analysis_content_for_summary = ""
-                for af in all_analysis_files:
-                    af_path = os.path.join(root, af)
-                    try:
-                        analysis_content_for_summary += read_file_with_fallback(af_path) + "\n\n--------------------\n\n"
-                    except Exception as e:
-                        print(f"DEBUG: Error reading {af} for summary generation: {e}")
-
-                prompt_summary = f"Synthesize the key observations derived from the provided medical image analysis. Clearly highlight any identified abnormalities, precisely specify their locations within the image(s), and articulate the potential clinical implications of these findings using clear and concise language. Ensure that each abnormality and its associated details are presented distinctly. Give a probability for each. Do not give any disclaimers. :\n\n{analysis_content_for_summary}"
-                try:
-                    print(f"DEBUG: Generating Gemini summary for: {os.path.basename(root)}")
-                    summary_response = model.generate_content([prompt_summary])
-                    summary_text = summary_response.text
-                    summary_output_path = os.path.join(root, f"summary_{model_name.replace('-', '_')}.txt")
-                    with open(summary_output_path, 'w') as outfile_summary:
-                        outfile_summary.write(summary_text)
-                    print(f"DEBUG: Generated summary and saved to: {summary_output_path}\n")
+            # Stale folder reports are rendered in parallel, one process per CPU
+            for (_, pdf_output_path, pdf_fingerprint), (_, error) in zip(
+                    pdf_jobs, render_reports([job[:2] for job in pdf_jobs], REPORT_WORKERS, font_path)):
+                if error:
+                    print(f"DEBUG: Error creating PDF summary '{pdf_output_path}': {error}")
+                    continue
+                self.manifest.record(pdf_output_path, pdf_fingerprint)
+                print(f"DEBUG: Successfully created/recreated PDF summary: '{pdf_output_path}'")
+            self.save_manifest()
 
-                    combined_summary_content += f"\n--- Summary for {os.path.basename(root)} ---\n{summary_text}\n"
-
-                    text_content = read_file_with_fallback(summary_output_path)
-
-                    pdf = FPDF()
-                    pdf.add_page()
-                    try:
-                        pdf.add_font('NotoSans', '', unicode_font_path)
-                        pdf.set_font('NotoSans', '', 8)
-                    except Exception as e:
-                        print(f"DEBUG: Error loading Unicode font: {e}")
-                        pdf.set_font("Helvetica", size=8)
-
-                    lines = text_content.split('\n')
-                    line_height = pdf.font_size * 1.5
-
-                    for line in lines:
-                        if line.strip():
-                            try:
-                                pdf.cell(0, line_height, line, ln=1, align='L')
-                            except Exception as e:
-                                encoded_line = line.encode('latin-1', 'ignore').decode('latin-1')
-                                pdf.cell(0, line_height, encoded_line, new_x="LMARGIN", new_y="NEXT", align='L')
-
-                    pdf_output_path = os.path.join(root, f"summary_{model_name.replace('-', '_')}.pdf")
-                    pdf.output(pdf_output_path, 'F')
-                    print(f"DEBUG: Successfully created/recreated PDF summary: '{pdf_output_path}'")
-
-                except Exception as e:
-                    print(f"DEBUG: Error generating or saving summary: {e}\n")
-
-# After the loop, write the combined analysis content to the top-level file
-try:
-    with open(combined_analysis_file_path, 'w', encoding='utf-8') as outfile:
-        outfile.write(all_combined_analysis_content)
-    print(f"DEBUG: Successfully created combined analysis file at: {combined_analysis_file_path}")
-except Exception as e:
-    print(f"DEBUG: Error writing to combined analysis file: {e}")
-
-
-final_summary_path_txt = os.path.join(main_image_dir, f"summary_{model_name.replace('-', '_')}.txt")
-
-try:
-    # Writing the combined summary content to a text file
-    with open(final_summary_path_txt, 'w', encoding='utf-8') as final_summary_file:
-        final_summary_file.write(combined_summary_content)
-    print(f"DEBUG: Successfully wrote combined summary content to: {final_summary_path_txt}")
-
-    # Reading the content from the text file for PDF generation
-    with open(final_summary_path_txt, 'r', encoding='utf-8') as final_summary_file:
-        text_content = final_summary_file.read()
-
-    # Check if the text content is empty and print a warning if so
-    if not text_content.strip():
-        print(f"Warning: The text content from {final_summary_path_txt} is empty. Skipping combined PDF generation.")
-    else:
-        # Create a new PDF document for the combined summary
-        pdf = FPDF()
-        pdf.add_page()
-
-        # Set up font (adding fallback for Unicode font)
         try:
-            pdf.add_font('NotoSans', '', unicode_font_path)
-            pdf.set_font('NotoSans', '', 8)
+            combined_pdf_fingerprint = self.manifest.fingerprint([self.final_summary_path], [REPORT_VERSION])
+            if self.manifest.is_current(self.combined_pdf_path, combined_pdf_fingerprint):
+                print(f"DEBUG: Combined PDF summary is up to date: {self.combined_pdf_path}")
+                return
+            # Check if the text content is empty and print a warning if so
+            with open(self.final_summary_path, 'r', encoding='utf-8') as final_summary_file:
+                has_content = any(line.strip() for line in final_summary_file)
+            if not has_content:
+                print(f"Warning: The text content from {self.final_summary_path} is empty. Skipping combined PDF generation.")
+            elif self.dry_run:
+                print(f"DEBUG: Dry run: would render the combined PDF summary: '{self.combined_pdf_path}'")
+            else:
+                # Lines are streamed from the file into the PDF
+                with open(self.final_summary_path, 'r', encoding='utf-8') as final_summary_file:
+                    ReportRenderer(font_path).render(final_summary_file, self.combined_pdf_path)
+                self.manifest.record(self.combined_pdf_path, combined_pdf_fingerprint)
+                print(f"Successfully created the combined PDF summary file: '{self.combined_pdf_path}'")
+        except FileNotFoundError:
+            print(f"Error: The file '{self.final_summary_path}' was not found for combined PDF conversion.")
         except Exception as e:
-            print(f"Error loading Unicode font: {e}")
-            pdf.set_font("Helvetica", size=8)  # Fallback to Helvetica
-
-        # Split the text content into lines
-        lines = text_content.split('\n')
-        line_height = pdf.font_size * 1.5
-
-        # Add each line to the PDF, handling potential encoding issues
-        for line in lines:
-            if line.strip():  # Only add non-empty lines
-                try:
-                    pdf.cell(0, line_height, line, new_x="LMARGIN", new_y="NEXT", align='L')
-                except Exception as e:
-                    print(f"Error writing line to combined PDF: {e}")
-                    encoded_line = line.encode('latin-1', 'ignore').decode('latin-1')
-                    pdf.cell(0, line_height, encoded_line, new_x="LMARGIN", new_y="NEXT", align='L')
-
-        # Define the output path for the combined PDF
-        pdf_output_path = os.path.join(main_image_dir, f"combined_summary_{model_name.replace('-', '_')}.pdf")
-        pdf.output(pdf_output_path)
-        print(f"Successfully created the combined PDF summary file: '{pdf_output_path}'")
-
-except FileNotFoundError:
-    print(f"Error: The file '{final_summary_path_txt}' was not found for combined PDF conversion.")
-except Exception as e:
-    print(f"An error occurred during combined PDF conversion: {e}")
-
-
-# --- Gemini API Request to Analyze the Final Summary ---
-final_summary_file_path = os.path.join(main_image_dir, f"summary_{model_name.replace('-', '_')}.txt")
-
-try:
-    with open(final_summary_file_path, 'r', encoding='utf-8') as f:
-        summary_content = f.read()
-
-    prompt_analyze = f"Analyze the provided medical summaries and synthesize the key observations. Identify and describe all abnormalities with precise anatomical locations, and explain the potential clinical implications of each finding in clear, concise language. Present each abnormality separately, assigning a probability to each. Avoid any disclaimers or use of tables. :\n\n{summary_content}"
-    analyze_response = model.generate_content([prompt_analyze])
-    analysis_result = analyze_response.text
-    #print(prompt_analyze)
-    #print("\n--- Gemini Analysis of Final Summary ---")
-    #print(analysis_result)
-
-    analysis_output_path = os.path.join(main_image_dir, f"analysis_of_summary_{model_name.replace('-', '_')}.txt")
-    with open(analysis_output_path, 'w', encoding='utf-8') as outfile:
-        outfile.write(analysis_result)
-    print(f"\nGemini's analysis of the final summary saved to: {analysis_output_path}")
-
-except FileNotFoundError:
-    print(f"Error: Final summary file not found at: {final_summary_file_path}")
-except Exception as e:
-    print(f"An error occurred during the Gemini analysis request: {e}")
-
-print("Processing complete.")
\ No newline at end of file
+            print(f"An error occurred during combined PDF conversion: {e}")
+        self.save_manifest()
+
+    def run_stage(self, name):
+        """Runs one stage by name ('analyse', 'summarise' or 'report'), timed as analysis.<name>."""
+        with metrics.timer(f'analysis.{name}', dry_run=self.dry_run):
+            return getattr(self, name)()
+
+    def run(self):
+        for name in COMMANDS:
+            self.run_stage(name)
+
+
+COMMANDS = {
+    'analyse': ("Analyse the key slices that have no up-to-date analysis.", ['analyze']),
+    'summarise': ("Write the folder summaries and the combined summary.", ['summarize']),
+    'report': ("Render the PDF reports.", []),
+}
+
+
+def add_options(parser, suppress=False):
+    def default(value):
+        # Subcommands only set the options given after them
+        return argparse.SUPPRESS if suppress else value
+
+    parser.add_argument('--root', default=default(DEFAULT_IMAGE_DIR),
+                        help=f"Folder of extracted images (default: {DEFAULT_IMAGE_DIR})")
+    parser.add_argument('--model', default=default(DEFAULT_MODEL_NAME),
+                        help=f"Model name (default: {DEFAULT_MODEL_NAME})")
+    parser.add_argument('--concurrency', type=int, default=default(ANALYSIS_WORKERS),
+                        help=f"Concurrent model requests (default: {ANALYSIS_WORKERS})")
+    parser.add_argument('--dry-run', action='store_true', default=default(False),
+                        help="Report what would be done without calling the model or writing files")
+    parser.add_argument('--backend', choices=BACKENDS, default=default('gemini'),
+                        help="Where requests go: the Gemini API, a local stub, the Gemini API with its responses "
+                             "recorded, or recorded responses only (default: gemini)")
+    parser.add_argument('--responses', default=default(None),
+                        help=f"Responses folder of the record and replay backends "
+                             f"(default: {DEFAULT_RESPONSES_DIR} next to the images folder)")
+    parser.add_argument('--stub-latency', type=float, default=default(0.0),
+                        help="Seconds each stub request takes (default: 0)")
+    parser.add_argument('--stub-error-rate', type=float, default=default(0.0),
+                        help="Fraction of stub requests that fail with a retryable error (default: 0)")
+    parser.add_argument('--requests-per-minute', type=int, default=default(REQUESTS_PER_MINUTE),
+                        help=f"Request quota, 0 for none (default: {REQUESTS_PER_MINUTE})")
+    parser.add_argument('--tokens-per-minute', type=int, default=default(TOKENS_PER_MINUTE),
+                        help=f"Token quota, 0 for none (default: {TOKENS_PER_MINUTE})")
+    parser.add_argument('--log-metrics', action='store_true', default=default(False),
+                        help="Print stage timings and request latencies as JSON lines, and all metrics at the end")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Analyse extracted DICOM images and build summaries and PDF reports. "
+                    "Without a command, every stage runs in order.",
+    )
+    add_options(parser)
+    subparsers = parser.add_subparsers(dest='command')
+    for name, (help_text, aliases) in COMMANDS.items():
+        add_options(subparsers.add_parser(name, aliases=aliases, help=help_text), suppress=True)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    responses_dir = args.responses or os.path.join(os.path.dirname(os.path.abspath(args.root)), DEFAULT_RESPONSES_DIR)
+    backend = create_backend(args.backend, args.model, responses_dir=responses_dir,
+                             latency=args.stub_latency, error_rate=args.stub_error_rate)
+    pipeline = AnalysisPipeline(
+        root=args.root, model_name=args.model, workers=args.concurrency, dry_run=args.dry_run, backend=backend,
+        requests_per_minute=args.requests_per_minute or None, tokens_per_minute=args.tokens_per_minute or None,
+    )
+    metrics.registry.log_events = args.log_metrics
+    if args.command is None:
+        pipeline.run()
+    else:
+        pipeline.run_stage(next(name for name, (_, aliases) in COMMANDS.items()
+                                if args.command == name or args.command in aliases))
+    metrics.event('metrics', **metrics.registry.snapshot())
+    print("Processing complete.")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,24 @@
+import io
 import os
-import time
+import queue
 import zipfile
 
-import pydicom
-from flask import Flask, render_template, request, send_from_directory
+import numpy as np
+from flask import Flask, jsonify, render_template, request, send_file
 from PIL import Image
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 
+from catalog import Catalog, default_catalog_path, get_image_files
+from derivatives import RENDITION_SIZES, DerivativeCache
+from image_formats import DEFAULT_PNG_COMPRESS_LEVEL, MIME_TYPES, file_version, find_slice_file, parse_output_formats
+from ingest import ingest_zip
+from instance_index import InstanceIndex, default_index_path
+from series_processor import parse_window
+from jobs import JobQueue
+import metrics
+from volume_store import HEADER_FILENAME, PLANES, SeriesVolume
+
 app = Flask(__name__)
 UPLOAD_FOLDER = 'uploads'
 OUTPUT_FOLDER = 'extracted_images'
@@ -14,191 +26,136 @@ ALLOWED_EXTENSIONS = {'zip'}
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
+app.config['EXTRACT_WORKERS'] = int(os.environ.get('EXTRACT_WORKERS', os.cpu_count() or 1))
+app.config['UPLOAD_JOB_WORKERS'] = int(os.environ.get('UPLOAD_JOB_WORKERS', 1))
+app.config['UPLOAD_QUEUE_SIZE'] = int(os.environ.get('UPLOAD_QUEUE_SIZE', 4))
+app.config['CATALOG_PATH'] = os.environ.get('CATALOG_PATH', default_catalog_path(OUTPUT_FOLDER))
+app.config['INSTANCE_INDEX_PATH'] = os.environ.get('INSTANCE_INDEX_PATH', default_index_path(OUTPUT_FOLDER))
+app.config['CATALOG_SYNC_INTERVAL'] = int(os.environ.get('CATALOG_SYNC_INTERVAL', 30))
+app.config['FOLDERS_PER_PAGE'] = 20
+app.config['DERIVATIVE_FOLDER'] = os.environ.get('DERIVATIVE_FOLDER', 'derivative_cache')
+app.config['DERIVATIVE_CACHE_BYTES'] = int(os.environ.get('DERIVATIVE_CACHE_BYTES', 512 * 1024 * 1024))
+app.config['IMAGE_CACHE_MAX_AGE'] = int(os.environ.get('IMAGE_CACHE_MAX_AGE', 7 * 24 * 3600))
+app.config['OUTPUT_FORMATS'] = parse_output_formats(os.environ.get('OUTPUT_FORMATS', 'png'))
+app.config['PNG_COMPRESS_LEVEL'] = int(os.environ.get('PNG_COMPRESS_LEVEL', DEFAULT_PNG_COMPRESS_LEVEL))
+app.config['WINDOW_PRESET'] = parse_window(os.environ.get('WINDOW_PRESET', 'auto'))
+app.config['WRITE_VOLUMES'] = os.environ.get('WRITE_VOLUMES', '1') != '0'
+app.config['METRICS_LOG'] = os.environ.get('METRICS_LOG', '0') == '1'
+metrics.registry.log_events = app.config['METRICS_LOG']
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
+catalog = Catalog(app.config['CATALOG_PATH'], OUTPUT_FOLDER, sync_interval=app.config['CATALOG_SYNC_INTERVAL'])
+instance_index = InstanceIndex(app.config['INSTANCE_INDEX_PATH'], OUTPUT_FOLDER)
+derivatives = DerivativeCache(app.config['DERIVATIVE_FOLDER'], app.config['DERIVATIVE_CACHE_BYTES'])
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def extract_dicom_to_png(dicom_path, output_dir):
-    """
-    Extracts pixel data from a DICOM file and saves it as a PNG image.
-    The output filename is based on the DICOM's Instance Number if available,
-    otherwise it defaults to the original filename.
-
-    Args:
-        dicom_path (str): Path to the input DICOM file.
-        output_dir (str): Path to the directory where the PNG will be saved.
-
-    Returns:
-        bool: True if the extraction was successful, False otherwise.
-    """
+def run_upload_job(job):
+    output_folder_base = app.config['OUTPUT_FOLDER']
     try:
-        dataset = pydicom.dcmread(dicom_path)
-        if 'PixelData' in dataset:
-            pixel_array = dataset.pixel_array
-            if len(pixel_array.shape) == 3:
-                # Handle color images (e.g., RGB)
-                image = Image.fromarray(pixel_array, 'RGB')
-            elif len(pixel_array.shape) == 2:
-                # Handle grayscale images
-                image = Image.fromarray(pixel_array).convert('L')
-            else:
-                print(f"Unsupported pixel array shape: {pixel_array.shape} in {dicom_path}")
-                return None
-
-            # Try to use the Instance Number for ordered filenames
-            if 'InstanceNumber' in dataset:
-                instance_number = str(dataset.InstanceNumber).zfill(6)  # Pad with zeros for consistent sorting
-                filename = f"{instance_number}.png"
-            else:
-                filename = os.path.basename(dicom_path).rsplit('.', 1)[0] + '.png'
-
-            output_path = os.path.join(output_dir, filename)
-            image.save(output_path)
-            print(f"Extracted: {dicom_path} -> {output_path}")
-            return True
-        else:
-            print(f"No PixelData found in: {dicom_path}")
-            return False
+        result = ingest_zip(job.filepath, output_folder_base, workers=app.config['EXTRACT_WORKERS'],
+                            on_series=lambda folder, results: catalog.refresh_folder(folder), progress=job.progress,
+                            formats=app.config['OUTPUT_FORMATS'], png_compress_level=app.config['PNG_COMPRESS_LEVEL'],
+                            window=app.config['WINDOW_PRESET'], volumes=app.config['WRITE_VOLUMES'], index=instance_index)
+        message = f"Extracted {result['extracted']} images into {len(result['series'])} series folders in: {os.path.basename(output_folder_base)}"
+        message += f" ({result['new']} new, {result['conflicting']} replaced with changed pixel data, {result['duplicate']} already stored"
+        if result['collisions']:
+            message += f", {result['collisions']} Instance Number collisions stored under suffixed names"
+        job.finish('done', message + ')')
+    except zipfile.BadZipFile:
+        job.finish('failed', 'Invalid zip file')
+    except ValueError as e:
+        job.finish('failed', str(e))
     except Exception as e:
-        print(f"Error processing {dicom_path}: {e}")
-        return False
+        job.finish('failed', f'Error extracting zip file: {e}')
+    finally:
+        os.remove(job.filepath)
 
-def get_folder_description(folder_path):
-    summary_path = os.path.join(folder_path, 'summary.txt')
-    if os.path.exists(summary_path):
-        try:
-            with open(summary_path, 'r') as f:
-                return f.read().strip()
-        except Exception as e:
-            return f"Error reading summary: {e}"
-    return "Summary not available yet."
+upload_jobs = JobQueue(run_upload_job, workers=app.config['UPLOAD_JOB_WORKERS'], max_pending=app.config['UPLOAD_QUEUE_SIZE'])
 
-def get_image_files(folder_path):
-    return sorted([f for f in os.listdir(folder_path) if os.path.isfile(os.path.join(folder_path, f)) and f.lower().endswith(('.png'))])
+def wants_json():
+    return request.accept_mimetypes.best == 'application/json'
+
+def render_index(status=200, **context):
+    catalog.sync()
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', app.config['FOLDERS_PER_PAGE'], type=int), 1), 200)
+    folder_data, total = catalog.list_folders(page, per_page)
+    jobs = [job.to_dict() for job in upload_jobs.active()]
+    return render_template('index.html', folders=folder_data, jobs=jobs, page=page, per_page=per_page,
+                           pages=max((total + per_page - 1) // per_page, 1), **context), status
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
-    extracted_image_path = os.path.join(os.getcwd(), app.config['OUTPUT_FOLDER'])
-    main_folders = [d for d in os.listdir(extracted_image_path) if os.path.isdir(os.path.join(extracted_image_path, d))]
-    folder_data = []
-    for main_folder in main_folders:
-        main_folder_path = os.path.join(extracted_image_path, main_folder)
-        subfolders_data = []
-        subfolders = [sub_d for sub_d in os.listdir(main_folder_path) if os.path.isdir(os.path.join(main_folder_path, sub_d))]
-        for subfolder in subfolders:
-            subfolder_path = os.path.join(main_folder_path, subfolder)
-            description = get_folder_description(subfolder_path)
-            images = get_image_files(subfolder_path)
-            subfolders_data.append({'name': subfolder, 'description': description, 'images': images})
-
-        description = get_folder_description(main_folder_path)
-        images = get_image_files(main_folder_path)
-        folder_data.append({'name': main_folder, 'description': description, 'subfolders': subfolders_data, 'images': images})
-
     if request.method == 'POST':
         if 'file' not in request.files:
-            return render_template('index.html', error='No file part', folders=folder_data)
+            return render_index(error='No file part')
         file = request.files['file']
         if file.filename == '':
-            return render_template('index.html', error='No selected file', folders=folder_data)
+            return render_index(error='No selected file')
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            # Prefix with a unique id so concurrent uploads of the same name don't collide
+            filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{os.urandom(8).hex()}_{filename}")
             file.save(filepath)
 
-            output_folder_base = app.config['OUTPUT_FOLDER']
-
             try:
-                with zipfile.ZipFile(filepath, 'r') as zip_ref:
-                    if not zip_ref.namelist():
-                        return render_template('index.html', error='Zip file is empty.', folders=folder_data)
-
-                    series_output_folders = {}
-
-                    for member in zip_ref.namelist():
-                        if not os.path.isdir(member):
-                            try:
-                                with zip_ref.open(member) as dicom_file:
-                                    temp_dicom_path = os.path.join(app.config['UPLOAD_FOLDER'], "temp_uid_" + os.path.basename(member))
-                                    with open(temp_dicom_path, 'wb') as f:
-                                        f.write(dicom_file.read())
-                                    try:
-                                        dataset = pydicom.dcmread(temp_dicom_path)
-                                        patient_name = dataset.PatientName if 'PatientName' in dataset else "UnknownPatient"
-                                        study_id = dataset.StudyID if 'StudyID' in dataset else "UnknownStudyID"
-                                        series_uid = dataset.SeriesInstanceUID if 'SeriesInstanceUID' in dataset else "UnknownSeriesUID"
-                                        sanitized_patient_name = "".join(c if c.isalnum() else "_" for c in patient_name)
-                                        sanitized_study_id = "".join(c if c.isalnum() else "_" for c in study_id)
-                                        sanitized_series_uid = "".join(c if c.isalnum() else "_" for c in series_uid)
-                                        series_base_folder = os.path.join(output_folder_base, f"{sanitized_patient_name}_{sanitized_study_id}")
-                                        series_output_path = os.path.join(series_base_folder, sanitized_series_uid)
-                                        series_output_folders[member] = series_output_path
-                                        os.makedirs(series_output_path, exist_ok=True)
-                                    except Exception as e:
-                                        print(f"Error reading DICOM header from {member} (UID): {e}")
-                                        fallback_folder = os.path.join(output_folder_base, "unknown_series_" + str(int(time.time())))
-                                        series_output_folders[member] = fallback_folder
-                                        os.makedirs(fallback_folder, exist_ok=True)
-                                    finally:
-                                        os.remove(temp_dicom_path)
-                            except Exception as e:
-                                print(f"Error opening member {member} for UID reading: {e}")
-
-                    for member in zip_ref.namelist():
-                        if not os.path.isdir(member):
-                            try:
-                                with zip_ref.open(member) as dicom_file:
-                                    temp_dicom_path = os.path.join(app.config['UPLOAD_FOLDER'], "temp_extract_" + os.path.basename(member))
-                                    with open(temp_dicom_path, 'wb') as f:
-                                        f.write(dicom_file.read())
-                                    extract_dicom_to_png(temp_dicom_path, series_output_folders[member])
-                                    os.remove(temp_dicom_path)
-                            except Exception as e:
-                                print(f"Error processing member {member} for extraction: {e}")
-
-                    # Re-generate folder data after extraction to include images
-                    extracted_image_path = os.path.join(os.getcwd(), app.config['OUTPUT_FOLDER'])
-                    main_folders = [d for d in os.listdir(extracted_image_path) if os.path.isdir(os.path.join(extracted_image_path, d))]
-                    folder_data = []
-                    for main_folder in main_folders:
-                        main_folder_path = os.path.join(extracted_image_path, main_folder)
-                        subfolders_data = []
-                        subfolders = [sub_d for sub_d in os.listdir(main_folder_path) if os.path.isdir(os.path.join(main_folder_path, sub_d))]
-                        for subfolder in subfolders:
-                            subfolder_path = os.path.join(main_folder_path, subfolder)
-                            description = get_folder_description(subfolder_path)
-                            images = get_image_files(subfolder_path)
-                            subfolders_data.append({'name': subfolder, 'description': description, 'images': images})
-
-                        description = get_folder_description(main_folder_path)
-                        images = get_image_files(main_folder_path)
-                        folder_data.append({'name': main_folder, 'description': description, 'subfolders': subfolders_data, 'images': images})
-
-                    return render_template('index.html', success=f'Successfully extracted images to series folders in: {os.path.basename(output_folder_base)}', folders=folder_data)
-
-            except zipfile.BadZipFile:
-                return render_template('index.html', error='Invalid zip file', folders=folder_data)
-            except Exception as e:
-                return render_template('index.html', error=f'Error extracting zip file: {e}', folders=folder_data)
-            finally:
+                job = upload_jobs.submit(filename, filepath)
+            except queue.Full:
                 os.remove(filepath)
+                if wants_json():
+                    return jsonify({'error': 'Too many uploads in progress, try again later.'}), 503
+                return render_index(503, error='Too many uploads in progress, try again later.')
+
+            if wants_json():
+                return jsonify({'job_id': job.id, 'status_url': f'/jobs/{job.id}'}), 202
+            return render_index(202, success=f'Upload queued as job {job.id}.')
+
+    return render_index()
+
+@app.route('/jobs')
+def list_jobs():
+    return jsonify([job.to_dict() for job in upload_jobs.jobs()])
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = upload_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found.'}), 404
+    return jsonify(job.to_dict())
 
-    return render_template('index.html', folders=folder_data)
+@app.route('/jobs/<job_id>/wait')
+def wait_for_job(job_id):
+    job = upload_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found.'}), 404
+    timeout = min(request.args.get('timeout', 30, type=float), 300)
+    finished = job.wait(timeout)
+    return jsonify(job.to_dict()), 200 if finished else 202
+
+@app.route('/metrics')
+def show_metrics():
+    snapshot = metrics.registry.snapshot()
+    snapshot['jobs'] = {'active': len(upload_jobs.active()), 'known': len(upload_jobs.jobs())}
+    return jsonify(snapshot)
 
 @app.route('/extracted_images/<path:folder>')
 def show_images(folder):
     folder_path = os.path.join(app.config['OUTPUT_FOLDER'], folder)
     if not os.path.isdir(folder_path):
         return render_template('error.html', message='Folder not found.')
-    image_files = get_image_files(folder_path)
-    return render_template('images.html', folder=folder, images=image_files)
+    listing = catalog.folder_images(folder_path) or {'images': get_image_files(folder_path), 'versions': {}}
+    return render_template('images.html', folder=folder, images=listing['images'], versions=listing['versions'])
 
 @app.route('/extracted_images/<folder>/<filename>')
 def download_image(folder, filename):
-    return send_from_directory(os.path.join(app.config['OUTPUT_FOLDER'], folder), filename)
+    # Series folders are two levels deep, so their galleries land here too
+    if os.path.isdir(os.path.join(app.config['OUTPUT_FOLDER'], folder, filename)):
+        return show_images(f"{folder}/{filename}")
+    return send_rendition(os.path.join(app.config['OUTPUT_FOLDER'], folder), filename)
 
 # New route to directly serve the specific image
 @app.route('/extracted_image/<path:image_path>')
@@ -206,10 +163,121 @@ def serve_specific_image(image_path):
     full_image_path = os.path.join(app.config['OUTPUT_FOLDER'], image_path)
     image_directory = os.path.dirname(full_image_path)
     image_filename = os.path.basename(full_image_path)
-    if os.path.isfile(full_image_path):
-        return send_from_directory(image_directory, image_filename)
-    else:
-        return render_template('error.html', message='Image not found.')
+    return send_rendition(image_directory, image_filename)
+
+@app.template_global()
+def rendition_url(image_path, size, version=None):
+    """
+    URL of an extracted image in a rendition. With the image's version from
+    the catalog (see image_formats.file_version) it is versioned (?v=), so
+    browsers may keep it for IMAGE_CACHE_MAX_AGE: a re-extracted image
+    gets a new URL.
+    """
+    url = f"/extracted_image/{image_path}?size={size}"
+    return f"{url}&v={version}" if version else url
+
+def send_rendition(directory, filename):
+    """
+    Serves an extracted image in the rendition named by the ?size= query
+    parameter (thumb, preview or full), with validators and caching headers.
+    A slice missing in the requested format is served from any other format
+    it was extracted in.
+
+    Only a request whose ?v= names the current rendition (see rendition_url)
+    may be cached for IMAGE_CACHE_MAX_AGE; any other must be revalidated,
+    since the image behind the URL changes when it is extracted again.
+    """
+    size = request.args.get('size', 'full')
+    if size not in RENDITION_SIZES:
+        return render_template('error.html', message=f'Unknown image size: {size}'), 400
+    source_path = find_slice_file(directory, filename) if safe_join(directory, filename) is not None else None
+    for _ in range(2):
+        if source_path is None:
+            break
+        try:
+            path, key = derivatives.get(source_path, size)
+            stat = os.stat(source_path)
+            max_age = app.config['IMAGE_CACHE_MAX_AGE'] if request.args.get('v') == file_version(stat) else 0
+            return send_file(os.path.abspath(path), mimetype=MIME_TYPES[os.path.splitext(path)[1].lower()], etag=key,
+                             conditional=True, last_modified=stat.st_mtime, max_age=max_age)
+        except FileNotFoundError:
+            # Evicted or re-extracted since it was found: look it up and render it again
+            source_path = find_slice_file(directory, filename)
+    return render_template('error.html', message='Image not found.'), 404
+
+def open_volume(folder):
+    folder_path = safe_join(app.config['OUTPUT_FOLDER'], folder)
+    if folder_path is None:
+        return None
+    try:
+        return SeriesVolume(folder_path)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def send_array(array, download_name, etag):
+    buffer = io.BytesIO()
+    np.save(buffer, np.ascontiguousarray(array))
+    buffer.seek(0)
+    return send_file(buffer, mimetype='application/octet-stream', download_name=download_name, etag=etag, conditional=True)
+
+def volume_etag(volume, *parts):
+    stat = os.stat(os.path.join(volume.folder, HEADER_FILENAME))
+    return '-'.join([str(stat.st_mtime_ns), *map(str, parts)])
+
+@app.route('/volume/<path:folder>/info')
+def volume_info(folder):
+    volume = open_volume(folder)
+    if volume is None:
+        return jsonify({'error': 'Volume not found.'}), 404
+    return jsonify(volume.header)
+
+@app.route('/volume/<path:folder>/slab/<int:start>/<int:stop>')
+def volume_slab(folder, start, stop):
+    """Stored values of slices start to stop (exclusive) as a .npy array."""
+    volume = open_volume(folder)
+    if volume is None:
+        return jsonify({'error': 'Volume not found.'}), 404
+    try:
+        slab = volume.slab(start, stop)
+    except IndexError as e:
+        return jsonify({'error': str(e)}), 400
+    return send_array(slab, f'slab_{start}_{stop}.npy', volume_etag(volume, 'slab', start, stop))
+
+@app.route('/volume/<path:folder>/<plane>/<int:index>')
+def volume_plane(folder, plane, index):
+    """
+    A slice (axial) or reformatted plane (coronal, sagittal) read from the
+    series volume. ?format=png (the default) windows it to 8-bit, with
+    ?window= as in WINDOW_PRESET, and scales it to the pixel spacing;
+    ?format=npy returns the stored values.
+    """
+    if plane not in PLANES:
+        return jsonify({'error': f'Unknown plane: {plane}'}), 404
+    output_format = request.args.get('format', 'png')
+    if output_format not in ('png', 'npy'):
+        return jsonify({'error': f'Unknown format: {output_format}'}), 400
+    try:
+        window = parse_window(request.args.get('window', 'auto'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    volume = open_volume(folder)
+    if volume is None:
+        return jsonify({'error': 'Volume not found.'}), 404
+    try:
+        if output_format == 'npy':
+            return send_array(volume.plane(plane, index), f'{plane}_{index}.npy', volume_etag(volume, plane, index))
+        display = volume.display(plane, index, window)
+    except IndexError as e:
+        return jsonify({'error': str(e)}), 400
+
+    image = Image.fromarray(display)
+    pixel_height, pixel_width = volume.aspect(plane)
+    if pixel_height != pixel_width:
+        image = image.resize((image.width, max(round(image.height * pixel_height / pixel_width), 1)), Image.BILINEAR)
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG', compress_level=app.config['PNG_COMPRESS_LEVEL'])
+    buffer.seek(0)
+    return send_file(buffer, mimetype='image/png', etag=volume_etag(volume, plane, index, window), conditional=True)
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,255 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import Counter
+
+import metrics
+from analysis_scheduler import IMAGE_TOKEN_ESTIMATE
+
+# Request kinds, so backends can tell per-image analyses from summaries
+ANALYSIS = 'analysis'
+SUMMARY = 'summary'
+AGGREGATE = 'aggregate'
+
+
+class ModelBackend:
+    """
+    Sends requests to a model. Subclasses implement generate(); the stage
+    methods only name the kind of request.
+
+    A request's parts are text prompts and inline image blobs
+    ({'mime_type', 'data'}), as taken by the Gemini generate_content call.
+    Every call returns the response text and the tokens it used (0 when
+    unknown). The stage methods record each request's latency as the
+    model.<kind> timing.
+    """
+
+    name = None
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+
+    def generate(self, parts, kind):
+        raise NotImplementedError
+
+    def _request(self, parts, kind):
+        metrics.incr(f'model.{kind}.requests')
+        try:
+            with metrics.timer(f'model.{kind}', backend=self.name, model=self.model_name) as fields:
+                text, tokens = self.generate(parts, kind)
+                fields['tokens'] = tokens
+        except Exception:
+            metrics.incr(f'model.{kind}.errors')
+            raise
+        metrics.incr('model.tokens', tokens)
+        return text, tokens
+
+    def analyse(self, prompt, images):
+        """Analysis of one image, or of several labelled images in one request."""
+        return self._request([prompt, *images], ANALYSIS)
+
+    def summarise(self, prompt):
+        """Summary of a folder's analyses."""
+        return self._request([prompt], SUMMARY)
+
+    def aggregate(self, prompt):
+        """Analysis of the combined summary."""
+        return self._request([prompt], AGGREGATE)
+
+
+class GeminiBackend(ModelBackend):
+    """The Gemini API. The SDK is imported on the first request."""
+
+    name = 'gemini'
+
+    def __init__(self, model_name, api_key=None):
+        super().__init__(model_name)
+        self.api_key = api_key
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        with self._lock:
+            if self._model is None:
+                import google.generativeai as genai
+
+                api_key = self.api_key or os.environ.get('GOOGLE_API_KEY')
+                if not api_key:
+                    raise RuntimeError("Set GOOGLE_API_KEY to call the model.")
+                genai.configure(api_key=api_key)
+                self._model = genai.GenerativeModel(self.model_name)
+        return self._model
+
+    def generate(self, parts, kind):
+        response = self.model.generate_content(parts)
+        usage = getattr(response, 'usage_metadata', None)
+        return response.text, getattr(usage, 'total_token_count', None) or 0
+
+
+class ServiceUnavailable(Exception):
+    """Simulated server error, retried by the scheduler like the SDK's own."""
+
+    code = 503
+
+
+def request_key(parts, kind, model_name):
+    """Content hash of a request: its kind, model, prompts and image bytes."""
+    digest = hashlib.sha256(f"{kind}\0{model_name}\0".encode('utf-8'))
+    for part in parts:
+        if isinstance(part, dict):
+            digest.update(b'\1' + part['mime_type'].encode('utf-8') + b'\0')
+            digest.update(hashlib.sha256(part['data']).digest())
+        else:
+            digest.update(b'\2' + str(part).encode('utf-8') + b'\0')
+    return digest.hexdigest()
+
+
+class StubBackend(ModelBackend):
+    """
+    Local stand-in for load tests and offline runs. Answers are derived from
+    a hash of the request, so the same request always gets the same answer,
+    and batched requests get one '### IMAGE <n>' section per image.
+
+    Args:
+        model_name (str): Reported in the answers; part of the request hash.
+        latency (float): Seconds each request takes.
+        jitter (float): Extra latency, up to this fraction of latency, also
+            derived from the request hash.
+        error_rate (float): Fraction of attempts, 0-1, that fail with
+            ServiceUnavailable. Whether an attempt fails depends on the
+            request and the attempt number, so retries can succeed and runs
+            are repeatable whatever the thread interleaving.
+        seed (int): Changes which attempts fail.
+        sleep (callable): Used to wait out the latency.
+    """
+
+    name = 'stub'
+
+    def __init__(self, model_name, latency=0.0, jitter=0.0, error_rate=0.0, seed=0, sleep=time.sleep):
+        super().__init__(model_name)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.seed = seed
+        self.sleep = sleep
+        self.calls = Counter()
+        self.errors = 0
+        self._attempts = Counter()
+        self._lock = threading.Lock()
+
+    def _fraction(self, *values):
+        digest = hashlib.sha256('\0'.join(str(value) for value in values).encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') / 2 ** 64
+
+    def generate(self, parts, kind):
+        key = request_key(parts, kind, self.model_name)
+        with self._lock:
+            self._attempts[key] += 1
+            attempt = self._attempts[key]
+            self.calls[kind] += 1
+        if self.latency:
+            self.sleep(self.latency * (1 + self.jitter * self._fraction(self.seed, key, 'latency')))
+        if self.error_rate and self._fraction(self.seed, key, attempt) < self.error_rate:
+            with self._lock:
+                self.errors += 1
+            raise ServiceUnavailable(f"Stub failure on attempt {attempt} of {kind} request {key[:12]}")
+
+        prompt = ' '.join(part for part in parts if isinstance(part, str))
+        images = [part for part in parts if isinstance(part, dict)]
+        if kind == ANALYSIS and len(images) > 1:
+            text = '\n\n'.join(
+                f"### IMAGE {number}\n{self._answer(kind, key, number)}" for number in range(1, len(images) + 1)
+            )
+        else:
+            text = self._answer(kind, key)
+        tokens = len(prompt) // 4 + len(images) * IMAGE_TOKEN_ESTIMATE + len(text) // 4
+        return text, tokens
+
+    def _answer(self, kind, key, number=None):
+        label = f"{kind} {key[:12]}" + (f" image {number}" if number else "")
+        probability = int(self._fraction(self.seed, key, number, 'probability') * 100)
+        return f"Stub {label} from {self.model_name}: no abnormalities found. Probability of correctness: {probability}%."
+
+
+class RecordReplayBackend(ModelBackend):
+    """
+    Stores responses on disk, keyed by request_key(), one JSON file each.
+
+    Modes:
+        record: every request goes to the wrapped backend; the response is stored.
+        replay: requests are answered from disk only; a request that was
+            never recorded raises LookupError.
+        auto: answers from disk when recorded, otherwise records.
+
+    Batched analyses are recorded and replayed whole, so a replay reproduces
+    sections the model left out as well.
+    """
+
+    name = 'replay'
+    MODES = ('record', 'replay', 'auto')
+
+    def __init__(self, directory, backend=None, mode='auto', model_name=None):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown record/replay mode: {mode}")
+        if mode != 'replay' and backend is None:
+            raise ValueError("Recording needs a backend to send requests to.")
+        super().__init__(model_name or backend.model_name)
+        self.directory = directory
+        self.backend = backend
+        self.mode = mode
+        self.hits = 0
+        self.recorded = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def generate(self, parts, kind):
+        key = request_key(parts, kind, self.model_name)
+        path = self._path(key)
+        if self.mode != 'record':
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    response = json.load(f)
+                with self._lock:
+                    self.hits += 1
+                return response['text'], response['tokens']
+            except FileNotFoundError:
+                if self.mode == 'replay':
+                    raise LookupError(f"No recorded response for {kind} request {key}")
+
+        text, tokens = self.backend.generate(parts, kind)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'kind': kind, 'model': self.model_name, 'text': text, 'tokens': tokens,
+                       'recorded_at': time.time()}, f)
+        os.replace(temp_path, path)
+        with self._lock:
+            self.recorded += 1
+        return text, tokens
+
+
+BACKENDS = ('gemini', 'stub', 'record', 'replay')
+
+
+def create_backend(name, model_name, api_key=None, responses_dir=None, **stub_options):
+    """
+    Builds a backend by name. 'record' stores the Gemini backend's responses
+    in responses_dir, 'replay' answers only from them. stub_options go to
+    StubBackend.
+    """
+    if name == 'gemini':
+        return GeminiBackend(model_name, api_key)
+    if name == 'stub':
+        return StubBackend(model_name, **stub_options)
+    if name in ('record', 'replay'):
+        if not responses_dir:
+            raise ValueError(f"The {name} backend needs a responses directory.")
+        if name == 'replay':
+            return RecordReplayBackend(responses_dir, mode='replay', model_name=model_name)
+        return RecordReplayBackend(responses_dir, GeminiBackend(model_name, api_key), mode='record')
+    raise ValueError(f"Unknown backend: {name}")
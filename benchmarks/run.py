@@ -0,0 +1,346 @@
+"""
+Throughput benchmarks of ingest, extraction, the catalog, report rendering
+and stub-backed analysis on synthetic DICOM archives.
+
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --scenarios ct16 --compare results.json
+
+Each benchmark runs --repeat times; the median run is reported, with the
+fastest alongside. Results are written as JSON and, with --compare, checked
+against an earlier results file: a benchmark whose throughput dropped by
+more than --tolerance makes the run exit with status 1.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import zipfile
+
+# The modules under test live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import PIL
+import pydicom
+
+import metrics
+from synthetic import available_transfer_syntaxes, write_archive
+
+# Archives generated per scenario; slices are multiplied by --scale
+SCENARIOS = {
+    'ct16': {'series': 2, 'slices': 64, 'rows': 256, 'columns': 256, 'bits': 16, 'frames': 1,
+             'transfer_syntax': 'explicit'},
+    'mr12_rle': {'series': 2, 'slices': 48, 'rows': 256, 'columns': 256, 'bits': 12, 'frames': 1,
+                 'transfer_syntax': 'rle'},
+    'ct16_j2k': {'series': 1, 'slices': 32, 'rows': 256, 'columns': 256, 'bits': 16, 'frames': 1,
+                 'transfer_syntax': 'j2k'},
+    'xa8_multiframe': {'series': 1, 'slices': 4, 'rows': 256, 'columns': 256, 'bits': 8, 'frames': 24,
+                       'transfer_syntax': 'explicit'},
+}
+
+REPORT_COUNT = 16
+REPORT_LINES = 120
+CATALOG_LISTS = 50
+
+
+@contextlib.contextmanager
+def quiet(enabled=True):
+    """
+    Sends stdout to /dev/null at the file descriptor level, so the per-slice
+    prints of extraction workers (separate processes) are silenced too.
+    """
+    if not enabled:
+        yield
+        return
+    sys.stdout.flush()
+    saved = os.dup(1)
+    with open(os.devnull, 'w') as devnull:
+        os.dup2(devnull.fileno(), 1)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                yield
+        finally:
+            sys.stdout.flush()
+            os.dup2(saved, 1)
+            os.close(saved)
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def measure(run, repeat, setup=None):
+    """
+    Times run(state) repeat times, with setup() called untimed before each.
+
+    Returns:
+        tuple: (seconds per run, result of the last run)
+    """
+    timings, result = [], None
+    for _ in range(repeat):
+        state = setup() if setup is not None else None
+        start = time.perf_counter()
+        result = run(state)
+        timings.append(time.perf_counter() - start)
+    return timings, result
+
+
+def summarise(scenario, benchmark, unit, items, timings, **extra):
+    seconds = statistics.median(timings)
+    return {
+        'scenario': scenario,
+        'benchmark': benchmark,
+        'unit': unit,
+        'items': items,
+        'runs': len(timings),
+        'seconds': seconds,
+        'seconds_min': min(timings),
+        'items_per_second': items / seconds if seconds else None,
+        **extra,
+    }
+
+
+def bench_ingest(name, archive, workdir, options):
+    from ingest import ingest_zip
+    from instance_index import InstanceIndex
+
+    runs = []
+
+    def setup():
+        output = os.path.join(workdir, f'ingest_{len(runs)}', 'extracted_images')
+        runs.append(output)
+        os.makedirs(output)
+        return output, InstanceIndex(os.path.join(os.path.dirname(output), 'instances.sqlite3'), output)
+
+    timings, result = measure(lambda state: ingest_zip(archive['path'], state[0], workers=options.workers,
+                                                       index=state[1]), options.repeat, setup)
+    output = runs[-1]
+    results = [summarise(name, 'ingest', 'slices', archive['frames'], timings, workers=options.workers,
+                         megabytes_per_second=archive['bytes'] / statistics.median(timings) / 1e6,
+                         failed=result['failed'])]
+
+    # The same archive again: every instance is a duplicate
+    index = InstanceIndex(os.path.join(os.path.dirname(output), 'instances.sqlite3'), output)
+    timings, result = measure(lambda state: ingest_zip(archive['path'], output, workers=options.workers, index=index),
+                              options.repeat)
+    results.append(summarise(name, 'ingest_resend', 'slices', archive['frames'], timings, workers=options.workers,
+                             duplicates=result['duplicate']))
+    return results, output
+
+
+def bench_extract(name, archive, workdir, options):
+    """Decode, window and encode in this process, from datasets already read into memory."""
+    from series_processor import process_series
+
+    def setup():
+        series = {}
+        with zipfile.ZipFile(archive['path']) as zip_ref:
+            for member in zip_ref.namelist():
+                series.setdefault(os.path.dirname(member), []).append(
+                    (pydicom.dcmread(io.BytesIO(zip_ref.read(member))), member))
+        output = tempfile.mkdtemp(dir=workdir, prefix='extract_')
+        return series, output
+
+    def run(state):
+        series, output = state
+        for folder, items in series.items():
+            datasets, names = zip(*items)
+            process_series(list(datasets), list(names), os.path.join(output, folder))
+
+    timings, _ = measure(run, options.repeat, setup)
+    return [summarise(name, 'extract', 'slices', archive['frames'], timings)]
+
+
+def bench_catalog(name, output, workdir, options):
+    from catalog import Catalog
+
+    databases = []
+
+    def cold_catalog():
+        databases.append(os.path.join(workdir, f'catalog_{len(databases)}.sqlite3'))
+        return Catalog(databases[-1], output)
+
+    timings, catalog = measure(lambda catalog: (catalog.sync(force=True), catalog)[1], options.repeat, cold_catalog)
+    folders = catalog.list_folders(1, 20)[1]
+    results = [summarise(name, 'catalog_sync', 'syncs', 1, timings, folders=folders)]
+
+    def list_pages(_):
+        for _ in range(CATALOG_LISTS):
+            catalog.list_folders(1, 20)
+
+    timings, _ = measure(list_pages, options.repeat)
+    results.append(summarise(name, 'catalog_list', 'pages', CATALOG_LISTS, timings))
+    return results
+
+
+def bench_analysis(name, output, workdir, options):
+    from analyze import AnalysisPipeline
+    from backends import StubBackend
+
+    def setup():
+        # A fresh copy each run, so no analysis is cached yet
+        root = os.path.join(tempfile.mkdtemp(dir=workdir, prefix='analysis_'), 'extracted_images')
+        shutil.copytree(output, root)
+        pipeline = AnalysisPipeline(root=root, model_name='stub-model', workers=options.analysis_workers,
+                                    backend=StubBackend('stub-model', latency=options.stub_latency),
+                                    requests_per_minute=None, tokens_per_minute=None)
+        return pipeline
+
+    def run(pipeline):
+        pipeline.analyse()
+        return pipeline
+
+    timings, pipeline = measure(run, options.repeat, setup)
+    analysed = sum(1 for _, _, files in os.walk(pipeline.root) for f in files if f.endswith(pipeline.analysis_suffix))
+    return [summarise(name, 'analysis', 'images', analysed, timings, requests=pipeline.backend.calls,
+                      stub_latency=options.stub_latency, workers=options.analysis_workers)]
+
+
+def bench_reports(workdir, options):
+    from reports import render_reports
+
+    text_dir = os.path.join(workdir, 'reports')
+    os.makedirs(text_dir)
+    rng = np.random.default_rng(0)
+    words = ['slice', 'series', 'density', 'lesion', 'normal', 'contrast', 'volume', 'margin', 'nodule', 'artifact']
+    jobs = []
+    for index in range(REPORT_COUNT):
+        text_path = os.path.join(text_dir, f'summary_{index}.txt')
+        with open(text_path, 'w', encoding='utf-8') as f:
+            for _ in range(REPORT_LINES):
+                f.write(' '.join(rng.choice(words, 14)) + '.\n')
+        jobs.append((text_path, os.path.join(text_dir, f'summary_{index}.pdf')))
+
+    timings, results = measure(lambda _: render_reports(jobs, options.report_workers), options.repeat)
+    return [summarise('reports', 'render_reports', 'reports', len(jobs), timings, workers=options.report_workers,
+                      failed=sum(1 for _, error in results if error))]
+
+
+def run_scenario(name, spec, workdir, options):
+    spec = dict(spec, slices=max(1, round(spec['slices'] * options.scale)))
+    workdir = os.path.join(workdir, name)
+    os.makedirs(workdir)
+    archive_path = os.path.join(workdir, f'{name}.zip')
+    log(f"{name}: generating {spec['series']} x {spec['slices']} instances ...")
+    archive = write_archive(archive_path, spec['series'], spec['slices'], spec['rows'], spec['columns'],
+                            spec['bits'], spec['frames'], spec['transfer_syntax'])
+    archive['path'] = archive_path
+
+    results = []
+    log(f"{name}: ingest")
+    with quiet(not options.verbose):
+        ingest_results, output = bench_ingest(name, archive, workdir, options)
+    results += ingest_results
+    for benchmark, function, source in (('extract', bench_extract, archive), ('catalog', bench_catalog, output),
+                                        ('analysis', bench_analysis, output)):
+        log(f"{name}: {benchmark}")
+        with quiet(not options.verbose):
+            results += function(name, source, workdir, options)
+    for result in results:
+        result['archive'] = {key: spec[key] for key in spec} | {'bytes': archive['bytes']}
+    return results
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'pydicom': pydicom.__version__,
+        'pillow': PIL.__version__,
+    }
+
+
+def compare(results, baseline_path, tolerance):
+    """Prints throughput against a baseline results file. Returns the regressions."""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = {(r['scenario'], r['benchmark']): r for r in json.load(f)['results']}
+    regressions = []
+    print(f"{'scenario':<16} {'benchmark':<16} {'baseline/s':>12} {'now/s':>12} {'change':>8}")
+    for result in results:
+        before = baseline.get((result['scenario'], result['benchmark']))
+        if before is None or not before.get('items_per_second') or not result.get('items_per_second'):
+            continue
+        ratio = result['items_per_second'] / before['items_per_second']
+        flag = '  REGRESSION' if ratio < 1 - tolerance else ''
+        print(f"{result['scenario']:<16} {result['benchmark']:<16} {before['items_per_second']:>12.1f} "
+              f"{result['items_per_second']:>12.1f} {ratio - 1:>+8.1%}{flag}")
+        if flag:
+            regressions.append(result)
+    return regressions
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark ingest, extraction, the catalog, reports and analysis.")
+    parser.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS), default=sorted(SCENARIOS),
+                        help="Archives to benchmark (default: all whose encoder is installed)")
+    parser.add_argument('--scale', type=float, default=1.0, help="Multiplier of the slices per series (default: 1)")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs of each benchmark (default: 3)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="Extraction processes for ingest (default: number of CPUs)")
+    parser.add_argument('--report-workers', type=int, default=None,
+                        help="Report rendering processes (default: number of CPUs)")
+    parser.add_argument('--analysis-workers', type=int, default=4, help="Concurrent stub requests (default: 4)")
+    parser.add_argument('--stub-latency', type=float, default=0.0, help="Seconds per stub request (default: 0)")
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help="Results file (default: benchmark_results.json)")
+    parser.add_argument('--compare', help="Earlier results file to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Throughput drop against --compare that counts as a regression (default: 0.2)")
+    parser.add_argument('--keep', action='store_true', help="Keep the generated archives and outputs")
+    parser.add_argument('--verbose', action='store_true', help="Show the output of the code under test")
+    return parser
+
+
+def main(argv=None):
+    options = build_parser().parse_args(argv)
+    encodable = available_transfer_syntaxes()
+    workdir = tempfile.mkdtemp(prefix='dicom_exporter_bench_')
+    metrics.registry.reset()
+    results, skipped = [], {}
+    try:
+        for name in options.scenarios:
+            if SCENARIOS[name]['transfer_syntax'] not in encodable:
+                skipped[name] = f"no encoder for {SCENARIOS[name]['transfer_syntax']}"
+                log(f"{name}: skipped, {skipped[name]}")
+                continue
+            results += run_scenario(name, SCENARIOS[name], workdir, options)
+        log("reports")
+        with quiet(not options.verbose):
+            results += bench_reports(workdir, options)
+    finally:
+        if options.keep:
+            log(f"Outputs kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'environment': environment(),
+        'options': {key: value for key, value in vars(options).items() if key not in ('output', 'compare', 'keep')},
+        'skipped': skipped,
+        'results': results,
+        'metrics': metrics.registry.snapshot(),
+    }
+    with open(options.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=1)
+
+    print(f"{'scenario':<16} {'benchmark':<16} {'items':>7} {'median s':>10} {'items/s':>10}")
+    for result in results:
+        print(f"{result['scenario']:<16} {result['benchmark']:<16} {result['items']:>7} {result['seconds']:>10.3f} "
+              f"{result['items_per_second'] or 0:>10.1f}")
+    print(f"Results written to {options.output}")
+    if options.compare and compare(results, options.compare, options.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
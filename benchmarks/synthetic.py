@@ -0,0 +1,160 @@
+"""
+Synthetic DICOM archives for the benchmarks.
+
+Every instance is a noisy elliptical phantom (air, soft tissue and a bone
+disc whose size changes along the series), so compression ratios, windowing
+and key-slice selection behave roughly as they do on real scans.
+
+    python benchmarks/synthetic.py archive.zip --slices 64 --bits 12 --transfer-syntax rle
+"""
+import argparse
+import io
+import zipfile
+
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.pixels import get_encoder
+from pydicom.uid import (
+    CTImageStorage,
+    ExplicitVRLittleEndian,
+    JPEG2000Lossless,
+    MultiFrameGrayscaleByteSecondaryCaptureImageStorage,
+    MultiFrameGrayscaleWordSecondaryCaptureImageStorage,
+    RLELossless,
+    SecondaryCaptureImageStorage,
+    generate_uid,
+)
+
+TRANSFER_SYNTAXES = {
+    'explicit': ExplicitVRLittleEndian,
+    'rle': RLELossless,
+    'j2k': JPEG2000Lossless,
+}
+
+# Stored bits -> bits allocated
+BIT_DEPTHS = {8: 8, 12: 16, 16: 16}
+
+
+def available_transfer_syntaxes():
+    """Names of the TRANSFER_SYNTAXES pydicom can encode here; j2k needs an optional plugin."""
+    return [name for name, uid in TRANSFER_SYNTAXES.items()
+            if uid == ExplicitVRLittleEndian or get_encoder(uid).is_available]
+
+
+def phantom(rows, columns, position, bits, rng):
+    """One (rows, columns) phantom slice at relative position 0..1 along the series."""
+    y, x = np.mgrid[-1:1:rows * 1j, -1:1:columns * 1j]
+    # Modality values in HU: air, a soft-tissue ellipse, a bone disc that grows and shrinks
+    values = np.full((rows, columns), -1000.0)
+    values[(x / 0.85) ** 2 + (y / 0.65) ** 2 <= 1] = 40
+    bone_radius = 0.1 + 0.15 * np.sin(np.pi * position)
+    values[(x - 0.3) ** 2 + y ** 2 <= bone_radius ** 2] = 700
+    values += rng.normal(0, 10, values.shape)
+    if bits == 8:
+        return np.clip((values + 1000) / 1700 * 255, 0, 255).astype(np.uint8)
+    return np.clip(values + 1024, 0, 2 ** bits - 1).astype(np.uint16)
+
+
+def make_instance(series_uid, instance_number, position, rows=256, columns=256, bits=16, frames=1,
+                  transfer_syntax='explicit', patient='Bench^Synthetic', study_id='1', seed=0):
+    """
+    One encoded DICOM instance.
+
+    Args:
+        series_uid (str): SeriesInstanceUID it belongs to.
+        instance_number (int): Its InstanceNumber.
+        position (float): Relative position along the series, 0..1.
+        bits (int): Bits stored, one of BIT_DEPTHS.
+        frames (int): Number of frames; above 1 makes a multi-frame
+            secondary capture object.
+        transfer_syntax (str): One of TRANSFER_SYNTAXES.
+
+    Returns:
+        bytes: The DICOM file.
+    """
+    rng = np.random.default_rng([seed, instance_number])
+    if frames > 1:
+        pixels = np.stack([phantom(rows, columns, position + index / (frames * 4), bits, rng)
+                           for index in range(frames)])
+        sop_class = MultiFrameGrayscaleByteSecondaryCaptureImageStorage if bits == 8 \
+            else MultiFrameGrayscaleWordSecondaryCaptureImageStorage
+    else:
+        pixels = phantom(rows, columns, position, bits, rng)
+        sop_class = SecondaryCaptureImageStorage if bits == 8 else CTImageStorage
+
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = sop_class
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = sop_class
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.PatientName = patient
+    ds.StudyID = study_id
+    ds.SeriesInstanceUID = series_uid
+    ds.InstanceNumber = instance_number
+    ds.Modality = 'OT' if bits == 8 else 'CT'
+    ds.Rows, ds.Columns = rows, columns
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = BIT_DEPTHS[bits]
+    ds.BitsStored = bits
+    ds.HighBit = bits - 1
+    ds.PixelRepresentation = 0
+    if frames > 1:
+        ds.NumberOfFrames = frames
+    if bits != 8:
+        ds.RescaleSlope, ds.RescaleIntercept = 1, -1024
+        ds.WindowCenter, ds.WindowWidth = 40, 400
+    ds.PixelSpacing = [0.7, 0.7]
+    ds.SliceThickness = 1.0
+    ds.ImagePositionPatient = [0.0, 0.0, float(instance_number)]
+    ds.PixelData = pixels.tobytes()
+    if transfer_syntax != 'explicit':
+        ds.compress(TRANSFER_SYNTAXES[transfer_syntax], pixels)
+
+    buffer = io.BytesIO()
+    ds.save_as(buffer, enforce_file_format=True)
+    return buffer.getvalue()
+
+
+def write_archive(path, series=1, slices=64, rows=256, columns=256, bits=16, frames=1,
+                  transfer_syntax='explicit', seed=0):
+    """
+    Writes a zip archive of synthetic series, each of slices instances.
+
+    Returns:
+        dict: 'members', 'frames' (slices in total) and 'bytes' (uncompressed
+        size of the DICOM files).
+    """
+    total_bytes = 0
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zip_ref:
+        for series_index in range(series):
+            series_uid = generate_uid()
+            for index in range(slices):
+                data = make_instance(series_uid, index + 1, index / max(slices - 1, 1), rows, columns, bits, frames,
+                                     transfer_syntax, seed=seed * 1000 + series_index)
+                zip_ref.writestr(f"series{series_index}/IM{index:05d}.dcm", data)
+                total_bytes += len(data)
+    return {'members': series * slices, 'frames': series * slices * frames, 'bytes': total_bytes}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a zip archive of synthetic DICOM series.")
+    parser.add_argument('path', help="Archive to write")
+    parser.add_argument('--series', type=int, default=1)
+    parser.add_argument('--slices', type=int, default=64, help="Instances per series")
+    parser.add_argument('--size', type=int, default=256, help="Rows and columns")
+    parser.add_argument('--bits', type=int, choices=sorted(BIT_DEPTHS), default=16, help="Bits stored")
+    parser.add_argument('--frames', type=int, default=1, help="Frames per instance")
+    parser.add_argument('--transfer-syntax', choices=sorted(TRANSFER_SYNTAXES), default='explicit')
+    args = parser.parse_args(argv)
+    if args.transfer_syntax not in available_transfer_syntaxes():
+        parser.error(f"No encoder for {args.transfer_syntax} is installed")
+    print(write_archive(args.path, args.series, args.slices, args.size, args.size, args.bits, args.frames,
+                        args.transfer_syntax))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import hashlib
+import json
+import os
+
+
+class BuildManifest:
+    """
+    Records, for each generated output, a fingerprint of the inputs it was
+    built from: the content hashes of its input files plus any extra text
+    such as the prompt and model name. An output whose recorded fingerprint
+    matches the current one is up to date and needs no rebuild.
+
+    File hashes are remembered with the file's size and mtime, so unchanged
+    inputs are not re-read on every run.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._outputs = {}
+        self._files = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self._outputs = data.get('outputs', {})
+                self._files = data.get('files', {})
+            except Exception as e:
+                print(f"DEBUG: Error reading build manifest {path}, rebuilding everything: {e}")
+
+    def file_hash(self, path):
+        stat = os.stat(path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        known = self._files.get(path)
+        if known and known['signature'] == signature:
+            return known['sha256']
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        self._files[path] = {'signature': signature, 'sha256': digest.hexdigest()}
+        return digest.hexdigest()
+
+    def fingerprint(self, files=(), extra=()):
+        """Fingerprint of the given input files (in order) and extra strings."""
+        digest = hashlib.sha256()
+        for path in files:
+            digest.update(f"{os.path.basename(path)}:{self.file_hash(path)}\0".encode('utf-8'))
+        for text in extra:
+            digest.update(hashlib.sha256(text.encode('utf-8')).digest())
+        return digest.hexdigest()
+
+    def is_current(self, output, fingerprint):
+        return os.path.exists(output) and self._outputs.get(output) == fingerprint
+
+    def adopt(self, output, fingerprint):
+        """
+        Treats an existing output with no record (built before the manifest
+        existed) as current. Returns True if it was adopted.
+        """
+        if output in self._outputs or not os.path.exists(output) or os.path.getsize(output) == 0:
+            return False
+        self._outputs[output] = fingerprint
+        return True
+
+    def record(self, output, fingerprint):
+        self._outputs[output] = fingerprint
+
+    def save(self):
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'outputs': self._outputs, 'files': self._files}, f)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,239 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+from image_formats import file_version, slice_files
+
+CATALOG_FILENAME = 'catalog.sqlite3'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS folders (
+    path TEXT PRIMARY KEY,
+    parent TEXT NOT NULL,
+    name TEXT NOT NULL,
+    description TEXT NOT NULL,
+    images TEXT NOT NULL,
+    image_count INTEGER NOT NULL,
+    dir_mtime_ns INTEGER NOT NULL,
+    summary_path TEXT,
+    summary_mtime_ns INTEGER NOT NULL,
+    versions TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS folders_parent ON folders (parent, name);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def default_catalog_path(output_folder):
+    """The catalog lives next to the extracted images folder, not inside it."""
+    return os.path.join(os.path.dirname(os.path.abspath(output_folder)), CATALOG_FILENAME)
+
+
+def find_summary_file(folder_path, entries=None):
+    """
+    Returns the path of the summary shown for a folder: a hand-written
+    summary.txt if present, otherwise the newest model summary_<model>.txt.
+    """
+    if entries is None:
+        entries = list(os.scandir(folder_path))
+    names = {entry.name: entry for entry in entries if entry.is_file()}
+    if 'summary.txt' in names:
+        return names['summary.txt'].path
+    model_summaries = [entry for name, entry in names.items() if name.startswith('summary_') and name.endswith('.txt')]
+    if model_summaries:
+        return max(model_summaries, key=lambda entry: entry.stat().st_mtime_ns).path
+    return None
+
+
+def get_folder_description(folder_path, summary_path=None):
+    summary_path = summary_path or find_summary_file(folder_path)
+    if summary_path and os.path.exists(summary_path):
+        try:
+            with open(summary_path, 'r') as f:
+                return f.read().strip()
+        except Exception as e:
+            return f"Error reading summary: {e}"
+    return "Summary not available yet."
+
+
+def get_image_files(folder_path, entries=None):
+    """One image per slice in the folder, in whichever format is preferred for display."""
+    if entries is None:
+        entries = os.scandir(folder_path)
+    return slice_files(entry.name for entry in entries if entry.is_file())
+
+
+def _mtime_ns(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+
+class Catalog:
+    """
+    SQLite index of the patient/study and series folders under the output
+    folder, with their image lists and summaries. Each image's version (see
+    image_formats.file_version) is kept too, so pages can link renditions
+    that browsers may cache without the images being stat'ed again.
+
+    Writers (extraction, analysis) call refresh_folder() for the folders they
+    touch. Changes made outside the app are picked up by sync(), which only
+    re-lists folders whose directory or summary mtime has changed.
+    """
+
+    def __init__(self, db_path, root, sync_interval=30):
+        self.db_path = db_path
+        self.root = os.path.abspath(root)
+        self.sync_interval = sync_interval
+        self._last_sync = 0
+        self._sync_lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            if 'versions' not in {row[1] for row in conn.execute('PRAGMA table_info(folders)')}:
+                # Catalogs from before image versions were kept: list every folder again
+                conn.execute("ALTER TABLE folders ADD COLUMN versions TEXT NOT NULL DEFAULT '{}'")
+                conn.execute('DELETE FROM folders')
+                conn.execute('DELETE FROM meta')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _relative(self, folder_path):
+        path = os.path.relpath(os.path.abspath(folder_path), self.root)
+        return '' if path == '.' else path.replace(os.sep, '/')
+
+    def refresh_folder(self, folder_path):
+        """
+        Re-reads one folder (and, for a top-level folder, its list of series
+        folders) into the catalog. Folders that no longer exist are removed.
+        """
+        path = self._relative(folder_path)
+        if not path or path.startswith('..') or path.count('/') > 1:
+            return
+        with self._connect() as conn:
+            self._refresh(conn, path)
+
+    def _refresh(self, conn, path):
+        abs_path = os.path.join(self.root, path)
+        parent, _, name = path.rpartition('/')
+        dir_mtime_ns = _mtime_ns(abs_path)
+        try:
+            entries = list(os.scandir(abs_path))
+        except OSError:
+            conn.execute('DELETE FROM folders WHERE path = ? OR parent = ?', (path, path))
+            return
+
+        summary_path = find_summary_file(abs_path, entries)
+        images = get_image_files(abs_path, entries)
+        by_name = {entry.name: entry for entry in entries}
+        versions = {}
+        for image in images:
+            try:
+                versions[image] = file_version(by_name[image].stat())
+            except OSError:
+                pass
+        conn.execute(
+            'INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (path, parent, name, get_folder_description(abs_path, summary_path), json.dumps(images), len(images),
+             dir_mtime_ns, summary_path, _mtime_ns(summary_path) if summary_path else 0, json.dumps(versions)),
+        )
+
+        if not parent:
+            subfolders = {entry.name for entry in entries if entry.is_dir()}
+            known = {row[0] for row in conn.execute('SELECT name FROM folders WHERE parent = ?', (path,))}
+            for subfolder in subfolders - known:
+                self._refresh(conn, f"{path}/{subfolder}")
+            for subfolder in known - subfolders:
+                conn.execute('DELETE FROM folders WHERE path = ?', (f"{path}/{subfolder}",))
+        elif not conn.execute('SELECT 1 FROM folders WHERE path = ?', (parent,)).fetchone():
+            self._refresh(conn, parent)
+
+    def sync(self, force=False):
+        """
+        Brings the catalog up to date with changes made on disk. Runs at most
+        once per sync_interval seconds unless forced.
+        """
+        if not force and time.time() - self._last_sync < self.sync_interval:
+            return
+        if not self._sync_lock.acquire(blocking=False):
+            return
+        try:
+            with metrics.timer('catalog.sync'), self._connect() as conn:
+                root_mtime_ns = _mtime_ns(self.root)
+                row = conn.execute("SELECT value FROM meta WHERE key = 'root_mtime_ns'").fetchone()
+                if row is None or int(row[0]) != root_mtime_ns:
+                    top_level = {entry.name for entry in os.scandir(self.root) if entry.is_dir()}
+                    known = {row[0] for row in conn.execute("SELECT path FROM folders WHERE parent = ''")}
+                    for path in top_level - known:
+                        self._refresh(conn, path)
+                    for path in known - top_level:
+                        conn.execute('DELETE FROM folders WHERE path = ? OR parent = ?', (path, path))
+                    conn.execute("INSERT OR REPLACE INTO meta VALUES ('root_mtime_ns', ?)", (str(root_mtime_ns),))
+
+                rows = conn.execute('SELECT path, dir_mtime_ns, summary_path, summary_mtime_ns FROM folders').fetchall()
+                for path, dir_mtime_ns, summary_path, summary_mtime_ns in rows:
+                    if _mtime_ns(os.path.join(self.root, path)) != dir_mtime_ns:
+                        self._refresh(conn, path)
+                    elif summary_path and _mtime_ns(summary_path) != summary_mtime_ns:
+                        # Summaries rewritten in place don't change the directory mtime
+                        self._refresh(conn, path)
+            self._last_sync = time.time()
+        finally:
+            self._sync_lock.release()
+
+    def folder_images(self, folder_path):
+        """
+        The catalogued images of a folder and their versions, as
+        ({'images', 'versions'}), or None if the folder is not catalogued.
+        """
+        with self._connect() as conn:
+            row = conn.execute('SELECT images, versions FROM folders WHERE path = ?',
+                               (self._relative(folder_path),)).fetchone()
+        if row is None:
+            return None
+        return {'images': json.loads(row[0]), 'versions': json.loads(row[1])}
+
+    def list_folders(self, page=1, per_page=20):
+        """
+        Returns one page of top-level folders in the shape index.html expects,
+        and the total number of top-level folders.
+        """
+        with metrics.timer('catalog.list'), self._connect() as conn:
+            total = conn.execute("SELECT COUNT(*) FROM folders WHERE parent = ''").fetchone()[0]
+            top_level = conn.execute(
+                "SELECT path, name, description, images, versions FROM folders WHERE parent = '' "
+                "ORDER BY name LIMIT ? OFFSET ?",
+                (per_page, (page - 1) * per_page),
+            ).fetchall()
+            folder_data = []
+            for path, name, description, images, versions in top_level:
+                subfolders = conn.execute(
+                    'SELECT name, description, images, versions FROM folders WHERE parent = ? ORDER BY name', (path,)
+                ).fetchall()
+                folder_data.append({
+                    'name': name,
+                    'description': description,
+                    'images': json.loads(images),
+                    'versions': json.loads(versions),
+                    'subfolders': [
+                        {'name': sub_name, 'description': sub_description, 'images': json.loads(sub_images),
+                         'versions': json.loads(sub_versions)}
+                        for sub_name, sub_description, sub_images, sub_versions in subfolders
+                    ],
+                })
+        return folder_data, total
@@ -0,0 +1,122 @@
+import hashlib
+import os
+import threading
+import time
+
+from PIL import Image
+
+import metrics
+from image_formats import MIME_TYPES, open_display_image
+
+# Longest edge in pixels of each sized rendition; 'full' is the original file,
+# or an 8-bit PNG of it for files browsers cannot show as they are (.npy, png16)
+RENDITION_SIZES = {
+    'thumb': 128,
+    'preview': 512,
+    'full': None,
+}
+
+# Image modes browsers display as they are
+DISPLAY_MODES = ('1', 'L', 'LA', 'P', 'RGB', 'RGBA')
+
+
+def _displayable(path):
+    """Whether browsers can show the file as it is: an 8-bit PNG or WebP, not a 16-bit one."""
+    if os.path.splitext(path)[1].lower() not in MIME_TYPES:
+        return False
+    with Image.open(path) as image:
+        return image.mode in DISPLAY_MODES
+
+
+class DerivativeCache:
+    """
+    On-disk cache of downscaled renditions of extracted images.
+
+    Renditions are generated on first request and keyed on the source path,
+    its mtime and size, so a re-extracted image gets fresh renditions. The
+    cache is kept under max_bytes by evicting the least recently served
+    files; last use is tracked in the file's atime so that the mtime (and
+    with it Last-Modified) stays stable.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._total_bytes = None
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(source_path, size):
+        stat = os.stat(source_path)
+        fingerprint = f"{os.path.abspath(source_path)}|{stat.st_mtime_ns}|{stat.st_size}|{size}"
+        return hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()
+
+    def get(self, source_path, size):
+        """
+        Returns (path, key) of the requested rendition of source_path,
+        generating it if needed. Renditions are 8-bit PNGs; 'full' returns
+        the source itself if browsers can show it, and otherwise the whole
+        image scaled to 8-bit like the smaller sizes.
+
+        Raises:
+            KeyError: If size is not one of RENDITION_SIZES.
+            FileNotFoundError: If source_path does not exist.
+        """
+        max_edge = RENDITION_SIZES[size]
+        key = self.key(source_path, size)
+        if max_edge is None and _displayable(source_path):
+            return source_path, key
+
+        path = os.path.join(self.cache_dir, key[:2], f"{key}.png")
+        try:
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+            metrics.incr('derivatives.hits')
+            return path, key
+        except FileNotFoundError:
+            # Not rendered yet, or evicted since
+            pass
+
+        metrics.incr('derivatives.misses')
+        with metrics.timer('derivatives.render', size=size):
+            image = open_display_image(source_path)
+            if max_edge is not None:
+                image.thumbnail((max_edge, max_edge))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            image.save(temp_path, format='PNG', compress_level=1)
+            os.replace(temp_path, path)
+        self._added(os.path.getsize(path))
+        return path, key
+
+    def _scan(self):
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if filename.endswith('.png'):
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    yield path, stat
+
+    def _added(self, nbytes):
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(stat.st_size for _, stat in self._scan())
+            else:
+                self._total_bytes += nbytes
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Drop the least recently served files until 10% below the cap
+        target = self.max_bytes * 0.9
+        for path, stat in sorted(self._scan(), key=lambda item: item[1].st_atime):
+            if self._total_bytes <= target:
+                break
+            try:
+                os.remove(path)
+                self._total_bytes -= stat.st_size
+            except OSError:
+                pass
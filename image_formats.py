@@ -0,0 +1,179 @@
+import os
+
+import numpy as np
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+
+# Formats an extracted slice can be written in, with their file extension
+OUTPUT_FORMATS = {
+    'png': '.png',
+    'png16': '.png',
+    'webp': '.webp',
+    'npy': '.npy',
+}
+DEFAULT_OUTPUT_FORMATS = ('png',)
+
+# When a slice exists in several formats, the first of these is listed and served
+SLICE_EXTENSIONS = ('.png', '.webp', '.npy')
+
+MIME_TYPES = {
+    '.png': 'image/png',
+    '.webp': 'image/webp',
+}
+
+# PNG text chunk of a png16 slice holding signed values: the offset added to
+# them to fit 0-65535, which open_image subtracts again
+PNG16_OFFSET_KEY = 'StoredValueOffset'
+
+# zlib level of 8-bit and 16-bit PNGs: 1 is several times faster to encode
+# than Pillow's default of 6, for files a little larger
+DEFAULT_PNG_COMPRESS_LEVEL = 1
+
+
+def parse_output_formats(value):
+    """
+    Parses a comma-separated list of output formats, such as 'png,npy'.
+
+    Raises:
+        ValueError: For an unknown format, or two formats writing the same
+            file extension (png and png16).
+    """
+    formats = tuple(dict.fromkeys(name.strip().lower() for name in value.split(',') if name.strip()))
+    if not formats:
+        raise ValueError('No output format given.')
+    unknown = [name for name in formats if name not in OUTPUT_FORMATS]
+    if unknown:
+        raise ValueError(f"Unknown output format: {', '.join(unknown)}. Choose from {', '.join(OUTPUT_FORMATS)}.")
+    extensions = [OUTPUT_FORMATS[name] for name in formats]
+    if len(set(extensions)) != len(extensions):
+        raise ValueError(f"Output formats {', '.join(formats)} would write the same files.")
+    return formats
+
+
+def write_slice(pixel_array, output_dir, stem, formats=DEFAULT_OUTPUT_FORMATS, png_compress_level=DEFAULT_PNG_COMPRESS_LEVEL,
+                display=None):
+    """
+    Writes a slice's pixel array as <stem>.<ext> in each of the given formats.
+
+    png and webp hold 8-bit grayscale or RGB; webp is written losslessly.
+    They are written from display, the slice already windowed to 8-bit,
+    when given. png16 keeps grayscale values up to 65535; signed values
+    are offset by half their type's range (32768 for 16-bit data) and the
+    offset is recorded in the PNG, see PNG16_OFFSET_KEY. npy keeps the
+    array exactly as decoded.
+
+    Returns:
+        list: The paths written.
+    """
+    paths = []
+    image_8bit = None
+    for name in formats:
+        path = os.path.join(output_dir, stem + OUTPUT_FORMATS[name])
+        if name == 'npy':
+            np.save(path, pixel_array)
+        elif name == 'png16' and pixel_array.ndim == 2:
+            offset, info = 0, None
+            if np.issubdtype(pixel_array.dtype, np.signedinteger):
+                offset = 2 ** (min(pixel_array.dtype.itemsize, 2) * 8 - 1)
+                info = PngInfo()
+                info.add_text(PNG16_OFFSET_KEY, str(offset))
+            image = Image.fromarray(np.clip(pixel_array.astype(np.int64) + offset, 0, 65535).astype(np.uint16))
+            image.save(path, format='PNG', compress_level=png_compress_level, pnginfo=info)
+        else:
+            if image_8bit is None and display is not None:
+                image_8bit = Image.fromarray(display, 'L')
+            elif image_8bit is None:
+                image_8bit = Image.fromarray(pixel_array, 'RGB') if pixel_array.ndim == 3 else Image.fromarray(pixel_array).convert('L')
+            if name == 'webp':
+                image_8bit.save(path, format='WEBP', lossless=True)
+            else:
+                image_8bit.save(path, format='PNG', compress_level=png_compress_level)
+        paths.append(path)
+    return paths
+
+
+def open_image(path):
+    """
+    Opens an extracted slice of any format as a PIL image, keeping its bit
+    depth: .npy arrays become 'L', 'I;16', 'I', 'F' or 'RGB' images, and
+    png16 slices of signed data 'I' images of their stored values.
+    """
+    if not path.lower().endswith('.npy'):
+        image = Image.open(path)
+        offset = image.info.get(PNG16_OFFSET_KEY)
+        if offset is None:
+            return image
+        with image:
+            return Image.fromarray(np.asarray(image, dtype=np.int32) - int(offset), 'I')
+    array = np.load(path, allow_pickle=False)
+    if array.ndim == 3:
+        return Image.fromarray(array.astype(np.uint8), 'RGB')
+    if array.dtype == np.uint8 or array.dtype == np.uint16:
+        return Image.fromarray(array)
+    if np.issubdtype(array.dtype, np.integer):
+        return Image.fromarray(array.astype(np.int32), 'I')
+    return Image.fromarray(array.astype(np.float32), 'F')
+
+
+def to_display(image):
+    """
+    Converts an image to 8-bit grayscale or RGB for display. Higher bit depths
+    are scaled from their own minimum and maximum instead of being clipped.
+    """
+    if image.mode in ('L', 'RGB'):
+        return image
+    if image.mode in ('I;16', 'I;16B', 'I', 'F'):
+        array = np.asarray(image, dtype=np.float32)
+        low, high = float(array.min()), float(array.max())
+        scale = 255.0 / (high - low) if high > low else 0.0
+        return Image.fromarray(((array - low) * scale).astype(np.uint8), 'L')
+    return image.convert('RGB' if image.mode in ('RGBA', 'P', 'CMYK', 'YCbCr') else 'L')
+
+
+def open_display_image(path):
+    """An extracted slice of any format as an 8-bit image for display or analysis."""
+    with open_image(path) as image:
+        image.load()
+        return to_display(image)
+
+
+def file_version(stat):
+    """
+    Short tag of an extracted file's content, from its os.stat() result:
+    it changes whenever the file is written again.
+    """
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+
+def slice_files(names):
+    """
+    Returns one filename per slice, sorted: where a slice exists in several
+    formats, the one listed first in SLICE_EXTENSIONS.
+    """
+    chosen = {}
+    for name in names:
+        stem, extension = os.path.splitext(name)
+        extension = extension.lower()
+        if extension not in SLICE_EXTENSIONS:
+            continue
+        if stem not in chosen or SLICE_EXTENSIONS.index(extension) < SLICE_EXTENSIONS.index(os.path.splitext(chosen[stem])[1].lower()):
+            chosen[stem] = name
+    return sorted(chosen.values())
+
+
+def find_slice_file(directory, filename):
+    """
+    Path of filename in directory or, if it is missing, of the same slice in
+    another format. Returns None if neither exists or filename is not a
+    slice image.
+    """
+    path = os.path.join(directory, filename)
+    stem, extension = os.path.splitext(path)
+    if extension.lower() not in SLICE_EXTENSIONS:
+        return None
+    if os.path.isfile(path):
+        return path
+    for extension in SLICE_EXTENSIONS:
+        if os.path.isfile(stem + extension):
+            return stem + extension
+    return None
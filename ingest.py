@@ -0,0 +1,640 @@
+import atexit
+import io
+import multiprocessing
+import os
+import re
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import pydicom
+
+import metrics
+from image_formats import DEFAULT_OUTPUT_FORMATS, DEFAULT_PNG_COMPRESS_LEVEL, OUTPUT_FORMATS
+from instance_index import pixel_checksum
+from series_processor import (dataset_frames, process_series, series_value_range, slice_stem,
+                              unwindowed_value_range)
+from volume_store import VOLUME_TAGS, create_volume, finish_volume, reuse_volume, volume_fields, write_frames
+
+# Everything the header-only pass needs to route, order and classify a member
+HEADER_TAGS = [
+    'PatientName',
+    'StudyID',
+    'SeriesInstanceUID',
+    'SOPInstanceUID',
+    'InstanceNumber',
+    'Rows',
+    'Columns',
+    'NumberOfFrames',
+] + VOLUME_TAGS
+
+# Slices of a series that one worker decodes, windows and writes together
+SLAB_SIZE = 32
+
+# Files of the frames of a multi-frame instance: <stem>_<frame>
+FRAME_STEM = re.compile(r'^(.*)_\d{4}$')
+
+_pool = None
+_pool_workers = None
+_worker_zip = None
+
+
+def sanitize(value):
+    return "".join(c if c.isalnum() else "_" for c in str(value))
+
+
+def series_output_path(dataset, output_folder_base):
+    """
+    Returns the series folder a dataset belongs in:
+    <output_folder_base>/<PatientName>_<StudyID>/<SeriesInstanceUID>.
+    """
+    patient_name = dataset.PatientName if 'PatientName' in dataset else "UnknownPatient"
+    study_id = dataset.StudyID if 'StudyID' in dataset else "UnknownStudyID"
+    series_uid = dataset.SeriesInstanceUID if 'SeriesInstanceUID' in dataset else "UnknownSeriesUID"
+    series_base_folder = os.path.join(output_folder_base, f"{sanitize(patient_name)}_{sanitize(study_id)}")
+    return os.path.join(series_base_folder, sanitize(series_uid))
+
+
+def extract_dataset_to_png(dataset, output_dir, source_name, formats=DEFAULT_OUTPUT_FORMATS,
+                           png_compress_level=DEFAULT_PNG_COMPRESS_LEVEL, window=None):
+    """
+    Saves the pixel data of an already parsed DICOM dataset as an image, by
+    default a PNG. The output filename is based on the DICOM's Instance
+    Number if available, otherwise it defaults to the original filename.
+
+    Args:
+        dataset (pydicom.Dataset): Parsed DICOM dataset, including PixelData.
+        output_dir (str): Path to the directory where the image will be saved.
+        source_name (str): Name of the source file, used for messages and
+            as the fallback output filename.
+        formats (tuple): Output formats, see image_formats.OUTPUT_FORMATS.
+        png_compress_level (int): zlib level of PNG output, 0-9.
+        window (tuple): VOI (center, width) for 8-bit output, or None for
+            the dataset's own window, see series_processor.
+
+    Returns:
+        bool: True if the extraction was successful, False otherwise.
+    """
+    [(_, error)] = process_series([dataset], [source_name], output_dir, formats, png_compress_level, window)
+    return error is None
+
+
+def extract_dicom_to_png(dicom_path, output_dir, formats=DEFAULT_OUTPUT_FORMATS,
+                         png_compress_level=DEFAULT_PNG_COMPRESS_LEVEL, window=None):
+    """
+    Extracts pixel data from a DICOM file and saves it as an image, by
+    default a PNG.
+
+    Args:
+        dicom_path (str): Path to the input DICOM file.
+        output_dir (str): Path to the directory where the image will be saved.
+        formats (tuple): Output formats, see image_formats.OUTPUT_FORMATS.
+        png_compress_level (int): zlib level of PNG output, 0-9.
+        window (tuple): VOI (center, width) for 8-bit output, or None for
+            the dataset's own window.
+
+    Returns:
+        bool: True if the extraction was successful, False otherwise.
+    """
+    try:
+        dataset = pydicom.dcmread(dicom_path)
+        return extract_dataset_to_png(dataset, output_dir, dicom_path, formats, png_compress_level, window)
+    except Exception as e:
+        print(f"Error processing {dicom_path}: {e}")
+        return False
+
+
+def read_header(fp):
+    """
+    Reads only the DICOM header elements needed to route and order an instance.
+
+    Parsing stops before PixelData and any other large element is deferred, so
+    only the first few hundred bytes of a member are decompressed.
+    """
+    return pydicom.dcmread(fp, defer_size='1 KB', stop_before_pixels=True, specific_tags=HEADER_TAGS)
+
+
+def scan_archive(zip_ref, output_folder_base, progress=None):
+    """
+    Header-only pass over a zip archive that builds its series manifest.
+
+    Args:
+        zip_ref (zipfile.ZipFile): The open archive.
+        output_folder_base (str): Root folder for the extracted series.
+        progress (callable): Optional progress callback, see ingest_zip.
+
+    Returns:
+        dict: 'series' maps each series folder to its image members, ordered
+        by Instance Number; 'skipped' lists members that are not images,
+        with the reason.
+    """
+    manifest = {'series': {}, 'skipped': []}
+    for info in zip_ref.infolist():
+        if info.is_dir():
+            continue
+        try:
+            with zip_ref.open(info) as member_file:
+                header = read_header(member_file)
+            error = None
+        except Exception as e:
+            print(f"Error reading DICOM header from {info.filename}: {e}")
+            header, error = None, f'unreadable header: {e}'
+        if progress is not None:
+            progress('scanned', info.filename)
+
+        if header is None:
+            manifest['skipped'].append({'member': info.filename, 'reason': error})
+            if progress is not None:
+                progress('skipped', info.filename, error)
+            continue
+
+        # Only objects carrying the Image Pixel module have anything to extract
+        if 'Rows' not in header or 'Columns' not in header:
+            manifest['skipped'].append({'member': info.filename, 'reason': 'no image data'})
+            if progress is not None:
+                progress('skipped', info.filename)
+            continue
+
+        entry = {
+            'member': info.filename,
+            'sop_instance_uid': str(header.SOPInstanceUID) if header.get('SOPInstanceUID') else None,
+            'stem': slice_stem(header, info.filename),
+            'instance_number': int(header.InstanceNumber) if header.get('InstanceNumber') is not None else None,
+            'frames': int(header.NumberOfFrames) if header.get('NumberOfFrames') is not None else 1,
+            'size': info.file_size,
+            'volume': volume_fields(header),
+        }
+        series_folder = series_output_path(header, output_folder_base)
+        manifest['series'].setdefault(series_folder, []).append(entry)
+
+    for entries in manifest['series'].values():
+        entries.sort(key=lambda entry: (entry['instance_number'] is None, entry['instance_number'] or 0, entry['member']))
+    return manifest
+
+
+def _stems_on_disk(folder):
+    """Output stems of the slices already in a series folder, frames counted under their instance's stem."""
+    try:
+        names = os.listdir(folder)
+    except FileNotFoundError:
+        return set()
+    extensions = set(OUTPUT_FORMATS.values())
+    stems = set()
+    for name in names:
+        stem, extension = os.path.splitext(name)
+        if extension.lower() in extensions:
+            stems.add(stem)
+            match = FRAME_STEM.match(stem)
+            if match:
+                stems.add(match.group(1))
+    return stems
+
+
+def assign_instances(manifest, index=None, progress=None):
+    """
+    Settles the output stem of every image member in the manifest and what
+    is already stored of it.
+
+    A member whose SOPInstanceUID is in the index for the same series keeps
+    the stem it was stored under, and its 'stored_checksum' is set so the
+    worker can skip it if the pixel data is unchanged. A member whose stem
+    is taken by a different instance, stored or earlier in the upload, gets
+    the first free '<stem>-<n>' instead of overwriting it. With an index,
+    slices on disk that it has no record of, e.g. extracted before it
+    existed, are taken over by the member with the same stem (a re-sent
+    instance is written over its old files and recorded), but are never
+    picked as a '<stem>-<n>'.
+
+    Args:
+        manifest (dict): As returned by scan_archive; updated in place.
+        index (instance_index.InstanceIndex): Stored instances, or None to
+            only keep the members of this upload apart.
+        progress (callable): Called as progress('collision', member, note).
+
+    Returns:
+        int: The number of Instance Number collisions.
+    """
+    all_uids = [entry['sop_instance_uid'] for entries in manifest['series'].values() for entry in entries
+                if entry['sop_instance_uid']]
+    stored = index.lookup(all_uids) if index is not None and all_uids else {}
+    collisions = 0
+    for folder, entries in manifest['series'].items():
+        taken = index.stems(folder) if index is not None else {}
+        unrecorded = _stems_on_disk(folder) - set(taken) if index is not None else set()
+        known = {}
+        for entry in entries:
+            record = stored.get(entry['sop_instance_uid'])
+            if record is not None and record['series'] == os.path.abspath(folder):
+                entry['stem'], entry['stored_checksum'] = record['stem'], record['checksum']
+                known[entry['member']] = True
+            else:
+                entry['stored_checksum'] = None
+
+        for entry in entries:
+            if entry['member'] in known:
+                continue
+            # Instances without a UID are told apart by member name
+            owner = entry['sop_instance_uid'] or entry['member']
+            stem = entry['stem']
+            if taken.get(stem, owner) != owner:
+                suffix = 2
+                while taken.get(f"{stem}-{suffix}", owner) != owner or \
+                        (f"{stem}-{suffix}" not in taken and f"{stem}-{suffix}" in unrecorded):
+                    suffix += 1
+                entry['stem'] = f"{stem}-{suffix}"
+                collisions += 1
+                note = (f"Instance Number collision in {os.path.basename(folder)}: {stem} is another instance, "
+                        f"stored as {entry['stem']}")
+                print(note)
+                if progress is not None:
+                    progress('collision', entry['member'], note)
+            taken[entry['stem']] = owner
+    return collisions
+
+
+def get_pool(workers):
+    """
+    Returns the shared extraction process pool, (re)creating it when the
+    requested worker count changes or a worker died and broke it.
+    """
+    global _pool, _pool_workers
+    # _broken is set once a worker exits abruptly; the pool then refuses all work
+    if _pool is None or _pool_workers != workers or getattr(_pool, '_broken', False):
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        # spawn rather than fork: the web app calls this from a threaded server
+        _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        _pool_workers = workers
+    return _pool
+
+
+@atexit.register
+def shutdown_pool():
+    global _pool, _pool_workers
+    if _pool is not None:
+        _pool.shutdown(wait=True)
+        _pool, _pool_workers = None, None
+
+
+def discard_pool(pool):
+    """Drops a broken pool, so the next get_pool() starts a fresh one."""
+    global _pool, _pool_workers
+    if _pool is pool:
+        _pool, _pool_workers = None, None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _failed(member, error):
+    return {'member': member, 'ok': False, 'error': error, 'outcome': None, 'checksum': None, 'in_volume': False}
+
+
+def _gather(pool, futures):
+    """
+    Yields (folder, member result) as slabs finish. If a worker dies, the
+    pool breaks and every slab still running or queued on it fails; slabs
+    that already finished keep their results.
+    """
+    for future in as_completed(futures):
+        folder, instances = futures[future]
+        try:
+            member_results = future.result()
+        except BrokenProcessPool as e:
+            print(f"Extraction worker died while processing {folder}: {e}")
+            discard_pool(pool)
+            member_results = [_failed(instance['member'], f'extraction worker died: {e}') for instance in instances]
+        for member_result in member_results:
+            yield folder, member_result
+
+
+def _open_worker_zip(zip_path):
+    # Each worker keeps the archive it is currently serving open between tasks
+    global _worker_zip
+    stat = os.stat(zip_path)
+    key = (zip_path, stat.st_ino, stat.st_mtime_ns)
+    if _worker_zip is None or _worker_zip[0] != key:
+        if _worker_zip is not None:
+            _worker_zip[1].close()
+        _worker_zip = (key, zipfile.ZipFile(zip_path, 'r'))
+    return _worker_zip[1]
+
+
+def measure_slab(zip_path, members):
+    """
+    Decodes a run of archive members from one series and returns the
+    modality value range of those without a VOI window, see
+    series_processor.unwindowed_value_range. Runs in a pool worker.
+    """
+    zip_ref = _open_worker_zip(zip_path)
+    datasets = []
+    for member in members:
+        try:
+            with zip_ref.open(member) as member_file:
+                datasets.append(pydicom.dcmread(io.BytesIO(member_file.read())))
+        except Exception as e:
+            print(f"Error reading member {member} to measure its values: {e}")
+    return unwindowed_value_range(datasets)
+
+
+def measure_series(zip_path, manifest, workers, skip=()):
+    """
+    The value range each series' windowless slices are windowed to, so that
+    every slab of a series is windowed alike. Only series with such slices
+    are decoded, in slabs across the pool; the rest, and series whose
+    values cannot be measured, fall back to their headers' range (see
+    series_processor.stored_value_range).
+
+    Args:
+        skip (set): Folders whose range is already known.
+
+    Returns:
+        dict: Maps the folders of series with windowless slices to their
+        (low, high) modality values.
+    """
+    folders = [folder for folder, entries in manifest['series'].items()
+               if folder not in skip and any(None in entry['volume']['window'] for entry in entries)]
+    tasks = [(folder, [entry['member'] for entry in manifest['series'][folder][start:start + SLAB_SIZE]])
+             for folder in folders for start in range(0, len(manifest['series'][folder]), SLAB_SIZE)]
+    measured = {folder: [] for folder in folders}
+    with metrics.timer('ingest.measure', series=len(folders)):
+        if workers == 1:
+            for folder, members in tasks:
+                measured[folder].append(measure_slab(zip_path, members))
+        elif tasks:
+            pool = get_pool(workers)
+            futures = {pool.submit(measure_slab, zip_path, members): folder for folder, members in tasks}
+            for future in as_completed(futures):
+                try:
+                    measured[futures[future]].append(future.result())
+                except BrokenProcessPool as e:
+                    print(f"Extraction worker died measuring {futures[future]}: {e}")
+                    discard_pool(pool)
+                except Exception as e:
+                    print(f"Error measuring the values of {futures[future]}: {e}")
+    return {folder: series_value_range(ranges) or
+            series_value_range(entry['volume']['value_range'] for entry in manifest['series'][folder])
+            for folder, ranges in measured.items()}
+
+
+def _stored_outputs_exist(output_dir, instance, formats):
+    stem = f"{instance['stem']}_0001" if instance['frames'] > 1 else instance['stem']
+    return all(os.path.exists(os.path.join(output_dir, stem + OUTPUT_FORMATS[output_format])) for output_format in formats)
+
+
+def extract_slab(zip_path, instances, output_dir, formats=DEFAULT_OUTPUT_FORMATS,
+                 png_compress_level=DEFAULT_PNG_COMPRESS_LEVEL, window=None, volume=None, value_range=None):
+    """
+    Decodes a run of archive members from one series and writes their
+    images, rescaling and windowing them together, and copies their stored
+    values into the series volume if it has one. Runs in a pool worker.
+
+    A member whose pixel data checksum equals its 'stored_checksum', and
+    whose images are all on disk, is a duplicate: it is not decoded or
+    written again, only copied into the volume.
+
+    Args:
+        instances (list): Per member: its 'member' name, output 'stem',
+            'frames' and 'stored_checksum' (None if not stored), see
+            assign_instances.
+        value_range (tuple): Modality value range of the whole series, for
+            slices without a VOI window, see measure_series.
+
+    Returns:
+        list: Per member, in order: the 'member' name, whether it was
+        extracted or already stored ('ok'), the 'error' message if not,
+        its 'outcome' ('new', 'duplicate' or 'conflict', a stored instance
+        whose pixel data changed), its pixel data 'checksum' and whether
+        its frames are in the volume ('in_volume').
+    """
+    results = {}
+    datasets, names, stems = [], [], []
+    duplicates = []
+    try:
+        zip_ref = _open_worker_zip(zip_path)
+    except Exception as e:
+        print(f"Error opening {zip_path} for extraction: {e}")
+        return [_failed(instance['member'], str(e)) for instance in instances]
+    for instance in instances:
+        member = instance['member']
+        try:
+            with zip_ref.open(member) as member_file:
+                dataset = pydicom.dcmread(io.BytesIO(member_file.read()))
+            checksum = pixel_checksum(dataset) if 'PixelData' in dataset else None
+        except Exception as e:
+            print(f"Error processing member {member} for extraction: {e}")
+            results[member] = _failed(member, str(e))
+            continue
+        stored = instance['stored_checksum']
+        if stored is not None and stored == checksum and _stored_outputs_exist(output_dir, instance, formats):
+            print(f"Already stored: {member}")
+            results[member] = {'member': member, 'ok': True, 'error': None, 'outcome': 'duplicate',
+                               'checksum': checksum, 'in_volume': False}
+            if volume is not None and not volume['existing']:
+                duplicates.append((member, dataset))
+            continue
+        results[member] = {'member': member, 'ok': False, 'error': None,
+                           'outcome': 'new' if stored is None or stored == checksum else 'conflict',
+                           'checksum': checksum, 'in_volume': False}
+        datasets.append(dataset)
+        names.append(member)
+        stems.append(instance['stem'])
+    try:
+        for member, error in process_series(datasets, names, output_dir, formats, png_compress_level, window, stems,
+                                            value_range):
+            results[member].update(ok=error is None, error=error)
+    except Exception as e:
+        print(f"Error processing members of {output_dir} for extraction: {e}")
+        for member in names:
+            results[member].update(ok=False, error=str(e))
+
+    if volume is not None:
+        # Extracted pixel arrays were decoded (and cached) by process_series
+        # above; duplicates are decoded here, for the volume only
+        written = [(member, dataset) for member, dataset in zip(names, datasets) if results[member]['ok']]
+        written += duplicates
+        try:
+            write_frames(volume, [(volume['starts'][member], dataset_frames(dataset)) for member, dataset in written])
+            for member, _ in written:
+                results[member]['in_volume'] = True
+        except Exception as e:
+            print(f"Error writing members of {output_dir} to its volume: {e}")
+        if volume['existing']:
+            # A reused volume already holds the duplicates
+            for member_result in results.values():
+                if member_result['outcome'] == 'duplicate':
+                    member_result['in_volume'] = True
+    return [results[instance['member']] for instance in instances]
+
+
+def ingest_zip(zip_path, output_folder_base, workers=None, on_series=None, progress=None,
+               formats=DEFAULT_OUTPUT_FORMATS, png_compress_level=DEFAULT_PNG_COMPRESS_LEVEL, window=None,
+               volumes=True, index=None):
+    """
+    Extracts every DICOM image in a zip archive into its series folder.
+
+    A header-only pass first builds the series manifest; pixel data is then
+    decoded only for the members it lists as images. Each series is split
+    into slabs of up to SLAB_SIZE slices in Instance Number order, and the
+    slabs are spread across a pool of worker processes. A worker reads its
+    members straight from the zip stream into memory, stacks them, applies
+    modality rescale and VOI windowing to the whole slab at once and writes
+    every output format; nothing else is written to disk.
+
+    With volumes on, each grayscale series whose slices share one size and
+    pixel format also gets a memory-mapped volume of its stored values (see
+    volume_store). It is allocated from the manifest before extraction
+    starts, and every worker writes its slab's slices into it in place.
+
+    With an instance index, instances that are already stored with the same
+    pixel data are skipped, and those whose pixel data changed are written
+    again under the filename they were stored as. A series re-sent in full
+    keeps its volume; only changed instances are written into it.
+
+    Args:
+        zip_path (str): Path to the uploaded zip archive.
+        output_folder_base (str): Root folder for the extracted series.
+        workers (int): Number of extraction processes. Defaults to the
+            number of CPUs; 1 extracts in the calling process.
+        on_series (callable): Called as on_series(series_folder, results)
+            once every member of a series is done, with the per-member
+            results in Instance Number order.
+        progress (callable): Called as progress(stage, member, error=None)
+            as members are 'scanned', 'skipped', 'extracted', 'failed' or
+            found to be a 'duplicate'. A member that is extracted over a
+            stored instance with other pixel data is first reported as a
+            'conflict', one whose Instance Number is taken in its series
+            as a 'collision'.
+        formats (tuple): Formats every slice is written in, see
+            image_formats.OUTPUT_FORMATS.
+        png_compress_level (int): zlib level of PNG output, 0-9.
+        window (tuple): VOI (center, width) for 8-bit output, or None for
+            each slice's own window, see series_processor.parse_window.
+        volumes (bool): Whether to write series volumes.
+        index (instance_index.InstanceIndex): Index of stored instances,
+            updated as instances are written; None extracts everything.
+
+    Returns:
+        dict: Counts of 'members', 'extracted', 'skipped' and 'failed'
+        members; of extracted members that were 'new' or 'conflicting',
+        of 'duplicate' members and of Instance Number 'collisions'; plus
+        the sorted list of 'series' folders that received images.
+
+    Raises:
+        zipfile.BadZipFile: If the archive cannot be read.
+        ValueError: If the archive contains no files.
+    """
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        if not any(not info.is_dir() for info in zip_ref.infolist()):
+            raise ValueError('Zip file is empty.')
+
+        with metrics.timer('ingest.scan') as scan_fields:
+            manifest = scan_archive(zip_ref, output_folder_base, progress)
+            collisions = assign_instances(manifest, index, progress)
+            scan_fields.update(members=len(zip_ref.infolist()), series=len(manifest['series']))
+
+    workers = workers or os.cpu_count() or 1
+    result = {
+        'members': sum(len(entries) for entries in manifest['series'].values()) + len(manifest['skipped']),
+        'extracted': 0,
+        'skipped': len(manifest['skipped']),
+        'failed': 0,
+        'new': 0,
+        'conflicting': 0,
+        'duplicate': 0,
+        'collisions': collisions,
+        'series': set(),
+    }
+
+    # Fan every image member out to the pool, then gather results per series
+    series_results = {folder: {} for folder in manifest['series']}
+    remaining = {folder: len(entries) for folder, entries in manifest['series'].items()}
+    layouts = {}
+    if volumes:
+        # A series re-sent in full keeps its volume, and the value range recorded with it
+        for folder, entries in manifest['series'].items():
+            if all(entry['stored_checksum'] is not None for entry in entries):
+                try:
+                    layouts[folder] = reuse_volume(folder, entries)
+                except Exception as e:
+                    print(f"Error reading the volume of {folder}: {e}")
+    # Slices without a VOI window get one range per series, measured before any is windowed
+    value_ranges = {}
+    if window is None:
+        ranged = {folder for folder, layout in layouts.items() if layout is not None and layout['value_range']}
+        value_ranges = measure_series(zip_path, manifest, workers, skip=ranged)
+        value_ranges.update({folder: layouts[folder]['value_range'] for folder in ranged})
+    if volumes:
+        for folder, entries in manifest['series'].items():
+            if layouts.get(folder) is not None:
+                continue
+            try:
+                layouts[folder] = create_volume(folder, entries, value_ranges.get(folder))
+                if layouts[folder] is not None and folder in value_ranges:
+                    # Match the slices the volume keeps from earlier uploads
+                    value_ranges[folder] = layouts[folder]['value_range']
+            except Exception as e:
+                print(f"Error creating the volume of {folder}: {e}")
+                layouts[folder] = None
+    tasks = [
+        (folder, [{key: entry[key] for key in ('member', 'stem', 'frames', 'stored_checksum')}
+                  for entry in entries[start:start + SLAB_SIZE]])
+        for folder, entries in manifest['series'].items()
+        for start in range(0, len(entries), SLAB_SIZE)
+    ]
+
+    with metrics.timer('ingest.extract', workers=workers) as extract_fields:
+        if workers == 1:
+            completed = ((folder, member_result) for folder, instances in tasks
+                         for member_result in extract_slab(zip_path, instances, folder, formats, png_compress_level, window,
+                                                           layouts.get(folder), value_ranges.get(folder)))
+        else:
+            pool = get_pool(workers)
+            futures = {pool.submit(extract_slab, zip_path, instances, folder, formats, png_compress_level, window,
+                                   layouts.get(folder), value_ranges.get(folder)): (folder, instances)
+                       for folder, instances in tasks}
+            completed = _gather(pool, futures)
+
+        for folder, member_result in completed:
+            series_results[folder][member_result['member']] = member_result
+            if member_result['outcome'] == 'duplicate':
+                result['duplicate'] += 1
+                stage = 'duplicate'
+            elif member_result['ok']:
+                result['extracted'] += 1
+                result['new' if member_result['outcome'] == 'new' else 'conflicting'] += 1
+                result['series'].add(folder)
+                stage = 'extracted'
+            else:
+                result['failed'] += 1
+                stage = 'failed'
+            if progress is not None:
+                if stage == 'extracted' and member_result['outcome'] == 'conflict':
+                    progress('conflict', member_result['member'])
+                progress(stage, member_result['member'], member_result['error'])
+
+            remaining[folder] -= 1
+            if remaining[folder] == 0:
+                entries = manifest['series'][folder]
+                if layouts.get(folder) is not None:
+                    finish_volume(folder, layouts[folder], series_results[folder].values())
+                if index is not None:
+                    stored = []
+                    for entry in entries:
+                        member_result = series_results[folder][entry['member']]
+                        if member_result['ok'] and member_result['outcome'] != 'duplicate' and \
+                                entry['sop_instance_uid'] and member_result['checksum']:
+                            stored.append((entry['sop_instance_uid'], entry['stem'], entry['instance_number'],
+                                           member_result['checksum']))
+                    index.record(folder, stored)
+                if on_series is not None:
+                    # Report back in Instance Number order, as listed in the manifest
+                    on_series(folder, [series_results[folder][entry['member']] for entry in entries])
+        extract_fields.update({key: result[key] for key in ('extracted', 'duplicate', 'failed')})
+
+    image_bytes = sum(entry['size'] for entries in manifest['series'].values() for entry in entries)
+    metrics.incr('ingest.uploads')
+    metrics.incr('ingest.bytes_read', image_bytes)
+    for key, counter in (('members', 'members'), ('extracted', 'slices_extracted'), ('duplicate', 'duplicates'),
+                         ('conflicting', 'conflicts'), ('failed', 'failed'), ('skipped', 'skipped')):
+        metrics.incr(f'ingest.{counter}', result[key])
+    result['series'] = sorted(result['series'])
+    return result
@@ -0,0 +1,104 @@
+import hashlib
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+INDEX_FILENAME = 'instances.sqlite3'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS instances (
+    sop_instance_uid TEXT PRIMARY KEY,
+    series TEXT NOT NULL,
+    stem TEXT NOT NULL,
+    instance_number INTEGER,
+    checksum TEXT NOT NULL,
+    stored_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS instances_series ON instances (series, stem);
+"""
+
+# SQLite's default limit on bound parameters is 999 on older builds
+_LOOKUP_CHUNK = 500
+
+
+def default_index_path(output_folder):
+    """The index lives next to the extracted images folder, like the catalog."""
+    return os.path.join(os.path.dirname(os.path.abspath(output_folder)), INDEX_FILENAME)
+
+
+def pixel_checksum(dataset):
+    """
+    SHA-1 of the dataset's Pixel Data element as encoded, so no decoding is
+    needed. The same pixels in another transfer syntax get another checksum.
+    """
+    return hashlib.sha1(dataset.PixelData).hexdigest()
+
+
+class InstanceIndex:
+    """
+    SQLite index of the instances stored under the output folder, keyed by
+    SOPInstanceUID, with the series folder and filename stem each was
+    written as and a checksum of its pixel data.
+
+    Ingest consults it to skip instances that are already stored, to tell
+    re-sent instances whose pixel data changed (conflicts) from duplicates,
+    and to keep instances that share an Instance Number in a series from
+    overwriting each other.
+    """
+
+    def __init__(self, db_path, root):
+        self.db_path = db_path
+        self.root = os.path.abspath(root)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _relative(self, folder_path):
+        return os.path.relpath(os.path.abspath(folder_path), self.root).replace(os.sep, '/')
+
+    def lookup(self, uids):
+        """
+        Returns {uid: {'series', 'stem', 'checksum'}} for the given
+        SOPInstanceUIDs that are stored; 'series' is the folder's path.
+        """
+        uids = list(uids)
+        found = {}
+        with self._connect() as conn:
+            for start in range(0, len(uids), _LOOKUP_CHUNK):
+                chunk = uids[start:start + _LOOKUP_CHUNK]
+                rows = conn.execute(
+                    f"SELECT sop_instance_uid, series, stem, checksum FROM instances "
+                    f"WHERE sop_instance_uid IN ({','.join('?' * len(chunk))})", chunk)
+                for uid, series, stem, checksum in rows:
+                    found[uid] = {'series': os.path.join(self.root, series), 'stem': stem, 'checksum': checksum}
+        return found
+
+    def stems(self, folder_path):
+        """Returns {stem: uid} of the instances stored in a series folder."""
+        with self._connect() as conn:
+            return dict(conn.execute('SELECT stem, sop_instance_uid FROM instances WHERE series = ?',
+                                     (self._relative(folder_path),)))
+
+    def record(self, folder_path, instances):
+        """
+        Records instances written to a series folder.
+
+        Args:
+            folder_path (str): The series folder.
+            instances (list): (uid, stem, instance_number, checksum) tuples.
+        """
+        series, now = self._relative(folder_path), time.time()
+        with self._connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?, ?, ?)',
+                             [(uid, series, stem, instance_number, checksum, now)
+                              for uid, stem, instance_number, checksum in instances])
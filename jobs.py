@@ -0,0 +1,166 @@
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import metrics
+
+# Upper bound on the error messages kept per job; the counters stay exact
+MAX_JOB_ERRORS = 100
+
+
+class Job:
+    """
+    Progress of one background upload. Counters are only written by the
+    thread running the job and read by the web routes.
+    """
+
+    def __init__(self, filename, filepath):
+        self.id = uuid.uuid4().hex
+        self.filename = filename
+        self.filepath = filepath
+        self.status = 'queued'
+        self.message = ''
+        self.members_scanned = 0
+        self.members_skipped = 0
+        self.slices_extracted = 0
+        self.slices_failed = 0
+        self.instances_duplicate = 0
+        self.instances_conflicting = 0
+        self.instance_collisions = 0
+        self.errors = []
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+
+    def progress(self, stage, member, error=None):
+        """Ingest progress callback, see ingest.ingest_zip."""
+        with self._lock:
+            if stage == 'scanned':
+                self.members_scanned += 1
+            elif stage == 'skipped':
+                self.members_skipped += 1
+            elif stage == 'extracted':
+                self.slices_extracted += 1
+            elif stage == 'failed':
+                self.slices_failed += 1
+            elif stage == 'duplicate':
+                self.instances_duplicate += 1
+            elif stage == 'conflict':
+                self.instances_conflicting += 1
+            elif stage == 'collision':
+                self.instance_collisions += 1
+            if error and len(self.errors) < MAX_JOB_ERRORS:
+                self.errors.append(f"{member}: {error}")
+
+    def finish(self, status, message=''):
+        with self._lock:
+            self.status = status
+            self.message = message
+            self.finished_at = time.time()
+        self._finished.set()
+
+    @property
+    def finished(self):
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        """Blocks until the job has finished. Returns True if it has."""
+        return self._finished.wait(timeout)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'id': self.id,
+                'filename': self.filename,
+                'status': self.status,
+                'message': self.message,
+                'members_scanned': self.members_scanned,
+                'members_skipped': self.members_skipped,
+                'slices_extracted': self.slices_extracted,
+                'slices_failed': self.slices_failed,
+                # Conflicting instances are extracted too, over the stored ones
+                'instances_new': self.slices_extracted - self.instances_conflicting,
+                'instances_duplicate': self.instances_duplicate,
+                'instances_conflicting': self.instances_conflicting,
+                'instance_collisions': self.instance_collisions,
+                'errors': list(self.errors),
+                'created_at': self.created_at,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+            }
+
+
+class JobQueue:
+    """
+    Runs upload jobs on a fixed set of background threads.
+
+    At most max_pending jobs may wait for a thread; submit() raises
+    queue.Full beyond that, so a burst of uploads cannot pile up unbounded
+    work. The most recent keep_finished finished jobs stay queryable.
+    """
+
+    def __init__(self, run, workers=1, max_pending=4, keep_finished=100):
+        self._run = run
+        self._workers = workers
+        self._pending = queue.Queue(maxsize=max_pending)
+        self._jobs = OrderedDict()
+        self._keep_finished = keep_finished
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def _start_threads(self):
+        while len(self._threads) < self._workers:
+            thread = threading.Thread(target=self._work, name=f"upload-job-{len(self._threads)}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self._pending.get()
+            job.status = 'running'
+            job.started_at = time.time()
+            metrics.observe('jobs.queue_wait', job.started_at - job.created_at, job=job.id)
+            try:
+                self._run(job)
+                if not job.finished:
+                    job.finish('done')
+            except Exception as e:
+                print(f"Error running upload job {job.id}: {e}")
+                job.finish('failed', str(e))
+            finally:
+                self._pending.task_done()
+
+    def submit(self, filename, filepath):
+        """
+        Queues a saved upload and returns its Job.
+
+        Raises:
+            queue.Full: If max_pending jobs are already waiting.
+        """
+        job = Job(filename, filepath)
+        with self._lock:
+            self._start_threads()
+            self._pending.put_nowait(job)
+            self._jobs[job.id] = job
+            self._prune()
+        return job
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - self._keep_finished)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def active(self):
+        return [job for job in self.jobs() if not job.finished]
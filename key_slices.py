@@ -0,0 +1,111 @@
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+from image_formats import open_display_image
+
+KEY_SLICES_FILENAME = 'key_slices.json'
+
+
+def load_thumbnails(image_paths, size=32):
+    """Stacks each image, reduced to size x size grayscale, into an (N, size*size) float array."""
+    thumbnails = np.empty((len(image_paths), size * size), dtype=np.float32)
+    for index, path in enumerate(image_paths):
+        image = open_display_image(path).convert('L')
+        thumbnails[index] = np.asarray(image.resize((size, size), Image.BILINEAR), dtype=np.float32).ravel()
+    return thumbnails
+
+
+def cluster_slices(thumbnails, threshold):
+    """
+    Groups consecutive slices into runs of near-duplicates.
+
+    The difference between neighbouring slices is the mean absolute
+    difference of their thumbnails, scaled to 0-1. A run is closed once the
+    summed differences since its first slice exceed threshold, which bounds
+    how far any two slices in a run can drift apart.
+
+    Returns:
+        list: One list of slice indices per cluster, in order.
+    """
+    count = len(thumbnails)
+    if count == 0:
+        return []
+    if threshold <= 0 or count == 1:
+        return [[index] for index in range(count)]
+
+    steps = np.abs(np.diff(thumbnails, axis=0)).mean(axis=1) / 255.0
+    clusters = [[0]]
+    drift = 0.0
+    for index, step in enumerate(steps, start=1):
+        drift += step
+        if drift > threshold:
+            clusters.append([index])
+            drift = 0.0
+        else:
+            clusters[-1].append(index)
+    return clusters
+
+
+def _fingerprint(folder_path, image_files):
+    # Name, mtime and size of every slice: any re-extracted or added slice changes it
+    files = []
+    for name in image_files:
+        stat = os.stat(os.path.join(folder_path, name))
+        files.append([name, stat.st_mtime_ns, stat.st_size])
+    return files
+
+
+def select_key_slices(folder_path, image_files, threshold, size=32, record=True):
+    """
+    Picks one representative slice per cluster of near-duplicates in a series
+    folder and records the coverage in key_slices.json.
+
+    The recorded coverage is reused without decoding any slice as long as
+    the folder's slices, their mtimes and sizes, and the threshold and
+    thumbnail size are unchanged.
+
+    Args:
+        folder_path (str): The series folder.
+        image_files (list): Slice filenames in the folder, in slice order.
+        threshold (float): Maximum drift within a cluster, 0-1. 0 keeps
+            every slice.
+        size (int): Edge length of the thumbnails that are compared.
+        record (bool): Write key_slices.json; False only computes the coverage.
+
+    Returns:
+        dict: Maps each representative filename to the filenames it covers.
+    """
+    fingerprint = _fingerprint(folder_path, image_files)
+    try:
+        with open(os.path.join(folder_path, KEY_SLICES_FILENAME), 'r', encoding='utf-8') as f:
+            recorded = json.load(f)
+        if recorded.get('threshold') == threshold and recorded.get('size') == size and \
+                recorded.get('files') == fingerprint:
+            return recorded['coverage']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    thumbnails = load_thumbnails([os.path.join(folder_path, f) for f in image_files], size)
+    coverage = {}
+    for cluster in cluster_slices(thumbnails, threshold):
+        # The middle slice is the closest to every other slice in the run
+        representative = image_files[cluster[len(cluster) // 2]]
+        coverage[representative] = [image_files[index] for index in cluster]
+
+    if not record:
+        return coverage
+    with open(os.path.join(folder_path, KEY_SLICES_FILENAME), 'w', encoding='utf-8') as f:
+        json.dump({'threshold': threshold, 'size': size, 'files': fingerprint, 'coverage': coverage}, f, indent=1)
+    return coverage
+
+
+def read_key_slices(folder_path):
+    """The coverage recorded by select_key_slices for a folder, or {}."""
+    try:
+        with open(os.path.join(folder_path, KEY_SLICES_FILENAME), 'r', encoding='utf-8') as f:
+            return json.load(f)['coverage']
+    except (OSError, ValueError, KeyError):
+        return {}
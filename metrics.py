@@ -0,0 +1,137 @@
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Recent samples kept per stage for the percentiles
+RESERVOIR_SIZE = 1024
+
+# Derived throughputs: counter per second of a stage's total time
+RATES = {
+    'ingest.slices_per_second': ('ingest.slices_extracted', 'ingest.extract'),
+    'ingest.bytes_per_second': ('ingest.bytes_read', 'ingest.extract'),
+    'reports.per_second': ('reports.rendered', 'reports.render'),
+}
+
+# Derived hit ratios: hits / (hits + misses)
+RATIOS = {
+    'derivatives.hit_ratio': ('derivatives.hits', 'derivatives.misses'),
+    'analysis_cache.hit_ratio': ('analysis_cache.hits', 'analysis_cache.misses'),
+}
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+class Metrics:
+    """
+    Process-wide counters and per-stage timings.
+
+    Stages are timed with timer() or observe(); each keeps its count, total,
+    min and max, and the recent samples for percentiles. With log_events on,
+    every timed stage and event() is also printed as one JSON line, for log
+    collectors. Extraction workers are separate processes, so their work
+    shows up in the timings of the stages that wait for them.
+    """
+
+    def __init__(self, log_events=False):
+        self.log_events = log_events
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started_at = time.time()
+            self._counters = {}
+            self._timings = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, stage, seconds, **fields):
+        """Records one timing of a stage; fields only go to the log line."""
+        with self._lock:
+            timing = self._timings.get(stage)
+            if timing is None:
+                timing = self._timings[stage] = {'count': 0, 'total': 0.0, 'min': seconds, 'max': seconds,
+                                                 'samples': deque(maxlen=RESERVOIR_SIZE)}
+            timing['count'] += 1
+            timing['total'] += seconds
+            timing['min'] = min(timing['min'], seconds)
+            timing['max'] = max(timing['max'], seconds)
+            timing['samples'].append(seconds)
+        self.event(stage, seconds=round(seconds, 6), **fields)
+
+    @contextmanager
+    def timer(self, stage, **fields):
+        """
+        Times the with block as one run of stage. The yielded dict can be
+        filled with fields for the log line, e.g. item counts.
+        """
+        fields = dict(fields)
+        start = time.perf_counter()
+        try:
+            yield fields
+        except Exception as e:
+            fields['error'] = str(e)
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start, **fields)
+
+    def event(self, name, **fields):
+        if self.log_events:
+            print(json.dumps({'time': round(time.time(), 3), 'event': name, **fields}, default=str), flush=True)
+
+    def snapshot(self):
+        """Counters, timing summaries and derived rates, as plain JSON types."""
+        with self._lock:
+            counters = dict(self._counters)
+            timings = {}
+            for stage, timing in self._timings.items():
+                ordered = sorted(timing['samples'])
+                timings[stage] = {
+                    'count': timing['count'],
+                    'total_seconds': timing['total'],
+                    'mean_seconds': timing['total'] / timing['count'],
+                    'min_seconds': timing['min'],
+                    'max_seconds': timing['max'],
+                    'p50_seconds': _percentile(ordered, 0.5),
+                    'p95_seconds': _percentile(ordered, 0.95),
+                }
+        rates = {}
+        for name, (counter, stage) in RATES.items():
+            if counter in counters and timings.get(stage, {}).get('total_seconds'):
+                rates[name] = counters[counter] / timings[stage]['total_seconds']
+        for name, (hits, misses) in RATIOS.items():
+            lookups = counters.get(hits, 0) + counters.get(misses, 0)
+            if lookups:
+                rates[name] = counters.get(hits, 0) / lookups
+        return {
+            'uptime_seconds': time.time() - self.started_at,
+            'counters': counters,
+            'timings': timings,
+            'rates': rates,
+        }
+
+
+# The registry the modules of this process record into
+registry = Metrics()
+
+
+def incr(name, value=1):
+    registry.incr(name, value)
+
+
+def observe(stage, seconds, **fields):
+    registry.observe(stage, seconds, **fields)
+
+
+def timer(stage, **fields):
+    return registry.timer(stage, **fields)
+
+
+def event(name, **fields):
+    registry.event(name, **fields)
@@ -0,0 +1,103 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from fpdf import FPDF
+
+import metrics
+
+DEFAULT_FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'NotoSans-Regular.ttf')
+
+
+class ReportRenderer:
+    """
+    Renders plain text into a simple one-column PDF report.
+
+    fpdf2 subsets the embedded font of each document in place, so a parsed
+    font cannot be shared between documents: each report parses the TTF
+    once, when its document is created, and report generation can be
+    spread over processes with render_reports(). If the Unicode font fails
+    to load, that is remembered and this and every later report fall back
+    to Helvetica, with text reduced to latin-1.
+    """
+
+    def __init__(self, font_path=DEFAULT_FONT_PATH, font_size=8):
+        self.font_size = font_size
+        self.font_path = font_path
+
+    def _new_document(self):
+        pdf = FPDF()
+        pdf.add_page()
+        if self.font_path:
+            try:
+                pdf.add_font('NotoSans', '', self.font_path)
+                pdf.set_font('NotoSans', '', self.font_size)
+                return pdf
+            except Exception as e:
+                print(f"DEBUG: Error loading Unicode font: {e}")
+                self.font_path = None
+        pdf.set_font("Helvetica", size=self.font_size)
+        return pdf
+
+    def render(self, lines, output_path):
+        """
+        Writes the non-blank lines of an iterable of text lines to a PDF,
+        wrapping long lines to the page width.
+        """
+        pdf = self._new_document()
+        line_height = pdf.font_size * 1.5
+        for line in lines:
+            line = line.rstrip('\n')
+            if not line.strip():
+                continue
+            if not self.font_path:
+                line = line.encode('latin-1', 'replace').decode('latin-1')
+            pdf.multi_cell(0, line_height, line, new_x="LMARGIN", new_y="NEXT", align='L')
+        pdf.output(output_path)
+
+    def render_file(self, text_path, output_path):
+        with open(text_path, 'r', encoding='utf-8', errors='replace') as f:
+            self.render(f, output_path)
+
+
+_worker_renderer = None
+
+
+def _init_worker(font_path, font_size):
+    global _worker_renderer
+    _worker_renderer = ReportRenderer(font_path, font_size)
+
+
+def _render_job(job):
+    text_path, output_path = job
+    try:
+        _worker_renderer.render_file(text_path, output_path)
+        return output_path, None
+    except Exception as e:
+        return output_path, str(e)
+
+
+def render_reports(jobs, workers=None, font_path=DEFAULT_FONT_PATH, font_size=8):
+    """
+    Renders many text files to PDF in parallel.
+
+    Args:
+        jobs (list): (text_path, pdf_path) pairs.
+        workers (int): Number of processes. Defaults to the number of CPUs;
+            1 renders in the calling process.
+
+    Returns:
+        list: (pdf_path, error) pairs in job order; error is None on success.
+    """
+    workers = min(workers or os.cpu_count() or 1, len(jobs)) if jobs else 1
+    with metrics.timer('reports.render', jobs=len(jobs), workers=workers):
+        if workers == 1:
+            _init_worker(font_path, font_size)
+            results = [_render_job(job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(font_path, font_size)) as pool:
+                results = list(pool.map(_render_job, jobs, chunksize=max(1, len(jobs) // (workers * 4))))
+    failed = sum(1 for _, error in results if error)
+    metrics.incr('reports.rendered', len(results) - failed)
+    metrics.incr('reports.failed', failed)
+    return results
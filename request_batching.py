@@ -0,0 +1,88 @@
+import io
+import os
+import re
+
+from image_formats import open_display_image
+
+# Marker the model is asked to start each image's analysis with
+SECTION_PATTERN = re.compile(r'^\W*IMAGE\s+(\d+)\W*$', re.IGNORECASE | re.MULTILINE)
+
+
+def prepare_image(path, max_edge=1024, quality=85):
+    """
+    Downscales an image to at most max_edge pixels on its longest side and
+    re-encodes it as JPEG for upload.
+
+    Returns:
+        dict: An inline blob part ({'mime_type', 'data'}) for generate_content.
+    """
+    image = open_display_image(path)
+    image.thumbnail((max_edge, max_edge))
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality)
+    return {'mime_type': 'image/jpeg', 'data': buffer.getvalue()}
+
+
+def pack_batches(tasks, max_images=8, max_bytes=4 * 1024 * 1024, payload_size=None):
+    """
+    Groups tasks into batches of at most max_images images from the same
+    folder, keeping the upload size under max_bytes. Task order is
+    preserved.
+
+    Args:
+        tasks (list): Image tasks with an 'image' path, and optionally the
+            size of its prepared payload ('payload_bytes').
+        max_images (int): Maximum images per request.
+        max_bytes (int): Budget for the images of one request.
+        payload_size (callable): Upload size of a task's image. Defaults
+            to its 'payload_bytes', else the size prepare_image encodes it
+            to with its default settings.
+
+    Returns:
+        list: Lists of tasks.
+    """
+    payload_size = payload_size or (lambda task: task['payload_bytes'] if 'payload_bytes' in task
+                                    else len(prepare_image(task['image'])['data']))
+    batches = []
+    batch, batch_bytes, batch_folder = [], 0, None
+    for task in tasks:
+        folder = os.path.dirname(task['image'])
+        size = payload_size(task)
+        if batch and (folder != batch_folder or len(batch) >= max_images or batch_bytes + size > max_bytes):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(task)
+        batch_bytes += size
+        batch_folder = folder
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def batch_prompt(prompt, labels):
+    """Wraps the per-image prompt for a request carrying several labelled images."""
+    listing = '\n'.join(f"IMAGE {number}: {label}" for number, label in enumerate(labels, start=1))
+    return (
+        f"{prompt}\n\nThe following {len(labels)} images are attached in this order:\n{listing}\n\n"
+        f"Analyze each image separately. Start the analysis of each image with a line containing only "
+        f"'### IMAGE <number>' and do not refer to the other images."
+    )
+
+
+def split_batch_response(text, count):
+    """
+    Splits a batched response into per-image analyses.
+
+    Returns:
+        dict: Maps 1-based image numbers to their analysis text. Images the
+        model left out are missing.
+    """
+    sections = {}
+    matches = list(SECTION_PATTERN.finditer(text))
+    for index, match in enumerate(matches):
+        number = int(match.group(1))
+        end = matches[index + 1].start() if index + 1 < len(matches) else len(text)
+        section = text[match.end():end].strip()
+        if 1 <= number <= count and section and number not in sections:
+            sections[number] = section
+    return sections
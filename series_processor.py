@@ -0,0 +1,275 @@
+import os
+
+import numpy as np
+
+from image_formats import DEFAULT_OUTPUT_FORMATS, DEFAULT_PNG_COMPRESS_LEVEL, write_slice
+
+# Named VOI windows as (center, width), in Hounsfield units
+WINDOW_PRESETS = {
+    'lung': (-600, 1500),
+    'mediastinum': (50, 350),
+    'abdomen': (40, 400),
+    'liver': (60, 160),
+    'bone': (400, 1800),
+    'brain': (40, 80),
+    'subdural': (75, 215),
+    'stroke': (32, 8),
+}
+
+
+def parse_window(value):
+    """
+    Parses a window setting: a name from WINDOW_PRESETS, 'center,width', or
+    '' / 'auto' for each slice's own WindowCenter/WindowWidth.
+
+    Returns:
+        tuple: (center, width), or None for the slices' own windows.
+
+    Raises:
+        ValueError: For an unknown preset or a malformed window.
+    """
+    value = (value or '').strip().lower()
+    if value in ('', 'auto'):
+        return None
+    if value in WINDOW_PRESETS:
+        return WINDOW_PRESETS[value]
+    try:
+        center, width = (float(part) for part in value.split(','))
+    except ValueError:
+        raise ValueError(f"Unknown window: {value}. Use one of {', '.join(WINDOW_PRESETS)}, 'center,width' or 'auto'.")
+    if width < 1:
+        raise ValueError(f"Window width must be at least 1, got {width:g}.")
+    return center, width
+
+
+def _first_float(dataset, keyword, default=None):
+    # Multi-valued windows list alternatives; the first is the primary one
+    value = dataset.get(keyword)
+    if value is None or value == '':
+        return default
+    if hasattr(value, '__len__') and not isinstance(value, (str, bytes)):
+        value = value[0] if len(value) else None
+    return default if value is None else float(value)
+
+
+def stored_value_range(dataset):
+    """
+    The modality values a grayscale instance can hold, from its header
+    alone: SmallestPixelValueInSeries to LargestPixelValueInSeries if both
+    are given, else the full range of BitsStored, with rescale applied.
+    Slices without a VOI window fall back to it only when their series'
+    actual values could not be measured (see unwindowed_value_range): for
+    data stored far below its bit depth, the full range is mostly black.
+
+    Returns:
+        tuple: (low, high), or None if the header has no bit depth.
+    """
+    low = _first_float(dataset, 'SmallestPixelValueInSeries')
+    high = _first_float(dataset, 'LargestPixelValueInSeries')
+    if low is None or high is None:
+        bits = dataset.get('BitsStored') or dataset.get('BitsAllocated')
+        if not bits:
+            return None
+        bits = int(bits)
+        if dataset.get('PixelRepresentation', 0):
+            low, high = -2.0 ** (bits - 1), 2.0 ** (bits - 1) - 1
+        else:
+            low, high = 0.0, 2.0 ** bits - 1
+    slope = _first_float(dataset, 'RescaleSlope', 1.0)
+    intercept = _first_float(dataset, 'RescaleIntercept', 0.0)
+    ends = (low * slope + intercept, high * slope + intercept)
+    return min(ends), max(ends)
+
+
+def series_value_range(ranges):
+    """The union of per-instance value ranges, skipping None; None if there are none."""
+    ranges = [value_range for value_range in ranges if value_range is not None]
+    if not ranges:
+        return None
+    return min(low for low, _ in ranges), max(high for _, high in ranges)
+
+
+def has_window(dataset):
+    """Whether a dataset carries its own VOI window (WindowCenter and WindowWidth)."""
+    return _first_float(dataset, 'WindowCenter') is not None and _first_float(dataset, 'WindowWidth') is not None
+
+
+def unwindowed_value_range(datasets):
+    """
+    The (low, high) modality values of the grayscale frames of the datasets
+    that have no VOI window, which window_stack windows them to; None if
+    there are none. Datasets whose pixel data cannot be decoded are left out.
+    """
+    ranges = []
+    for dataset in datasets:
+        if has_window(dataset) or 'PixelData' not in dataset:
+            continue
+        try:
+            frames = dataset_frames(dataset)
+        except Exception:
+            continue
+        if frames.ndim != 3:
+            continue
+        slope = _first_float(dataset, 'RescaleSlope', 1.0)
+        intercept = _first_float(dataset, 'RescaleIntercept', 0.0)
+        ends = (float(frames.min()) * slope + intercept, float(frames.max()) * slope + intercept)
+        ranges.append((min(ends), max(ends)))
+    return series_value_range(ranges)
+
+
+def slice_stem(dataset, source_name):
+    """Output filename stem: the zero-padded Instance Number, else the source filename."""
+    if 'InstanceNumber' in dataset and dataset.InstanceNumber is not None and str(dataset.InstanceNumber) != '':
+        return str(dataset.InstanceNumber).zfill(6)  # Pad with zeros for consistent sorting
+    return os.path.basename(source_name).rsplit('.', 1)[0]
+
+
+def dataset_frames(dataset):
+    """
+    The dataset's pixel data as a stack of frames: (frames, rows, columns)
+    for grayscale, (frames, rows, columns, samples) for color.
+
+    Raises:
+        ValueError: If the array does not have the expected shape.
+    """
+    pixel_array = dataset.pixel_array
+    samples = int(dataset.get('SamplesPerPixel', 1) or 1)
+    frames = int(dataset.get('NumberOfFrames', 1) or 1)
+    expected = 2 + (samples > 1) + (frames > 1)
+    if pixel_array.ndim != expected:
+        raise ValueError(f"Unsupported pixel array shape: {pixel_array.shape}")
+    return pixel_array if frames > 1 else pixel_array[np.newaxis]
+
+
+def modality_rescale(volume, slopes, intercepts):
+    """Applies RescaleSlope/Intercept to a (slices, rows, columns) stack, one pair per slice."""
+    return volume.astype(np.float32) * slopes[:, None, None] + intercepts[:, None, None]
+
+
+def voi_window(volume, centers, widths):
+    """
+    Maps a stack of modality values to 8-bit with the DICOM linear VOI
+    function (PS3.3 C.11.2.1.2), one center and width per slice.
+    """
+    centers = centers[:, None, None]
+    scale = np.maximum(widths - 1, 1)[:, None, None]
+    out = np.clip((volume - (centers - 0.5)) / scale + 0.5, 0.0, 1.0)
+    return np.rint(out * 255).astype(np.uint8)
+
+
+def window_stack(volume, slopes, intercepts, centers, widths, invert, value_range=None):
+    """
+    Rescales and windows a stack of same-sized grayscale slices in one pass.
+
+    Args:
+        volume (numpy.ndarray): Stored values, (slices, rows, columns).
+        slopes, intercepts (numpy.ndarray): Modality rescale per slice.
+        centers, widths (numpy.ndarray): VOI window per slice; NaN where a
+            slice has none, which then get a window spanning value_range.
+        invert (numpy.ndarray): True for MONOCHROME1 slices, shown inverted.
+        value_range (tuple): (low, high) modality values of the series, see
+            unwindowed_value_range. Without it, the min-max of the
+            windowless slices in the stack is used (the full range for
+            8-bit data).
+
+    Returns:
+        numpy.ndarray: The 8-bit display stack.
+    """
+    values = modality_rescale(volume, slopes, intercepts)
+    missing = np.isnan(centers) | np.isnan(widths)
+    if missing.any():
+        if value_range is not None:
+            low, high = value_range
+        elif volume.dtype == np.uint8:
+            low, high = 0.0, 255.0
+        else:
+            low, high = float(values[missing].min()), float(values[missing].max())
+        centers = np.where(missing, (low + high) / 2, centers)
+        widths = np.where(missing, max(high - low, 1.0), widths)
+    display = voi_window(values, centers, widths)
+    if invert.any():
+        display[invert] = 255 - display[invert]
+    return display
+
+
+def process_series(datasets, source_names, output_dir, formats=DEFAULT_OUTPUT_FORMATS,
+                   png_compress_level=DEFAULT_PNG_COMPRESS_LEVEL, window=None, stems=None, value_range=None):
+    """
+    Writes the slices of one series, or of a slab of it, in the given formats.
+
+    Grayscale frames of the same size are stacked into one volume, and
+    modality rescale and VOI windowing are applied to the whole volume at
+    once for the 8-bit formats (png, webp). png16 and npy keep the stored
+    values. Multi-frame objects are written one file per frame, as
+    <stem>_<frame>. Color images are written as they are.
+
+    Args:
+        datasets (list): Parsed datasets, including PixelData.
+        source_names (list): Source file of each dataset, for messages and
+            fallback filenames.
+        output_dir (str): The series folder.
+        formats (tuple): Output formats, see image_formats.OUTPUT_FORMATS.
+        png_compress_level (int): zlib level of PNG output, 0-9.
+        window (tuple): (center, width) applied to every slice, or None for
+            each slice's own WindowCenter/WindowWidth.
+        stems (list): Output filename stem of each dataset, overriding
+            slice_stem(), e.g. to keep colliding Instance Numbers apart.
+        value_range (tuple): (low, high) modality values slices without a
+            window are windowed to; defaults to the min-max of those
+            slices. Pass the whole series' range when writing a slab of it,
+            so that every slab is windowed alike.
+
+    Returns:
+        list: (source_name, error) per dataset, in order; error is None if
+        every frame was written.
+    """
+    errors = {}
+    frames = []  # (dataset index, stem, frame array)
+    for index, (dataset, source_name) in enumerate(zip(datasets, source_names)):
+        if 'PixelData' not in dataset:
+            print(f"No PixelData found in: {source_name}")
+            errors[index] = 'no pixel data'
+            continue
+        try:
+            stack = dataset_frames(dataset)
+        except Exception as e:
+            print(f"{e} in {source_name}")
+            errors[index] = str(e)
+            continue
+        stem = stems[index] if stems is not None else slice_stem(dataset, source_name)
+        for frame_index, frame in enumerate(stack):
+            frames.append((index, f"{stem}_{frame_index + 1:04d}" if len(stack) > 1 else stem, frame))
+
+    # Grayscale frames of the same size share one vectorized rescale and window
+    displays = {}
+    groups = {}
+    for position, (index, _, frame) in enumerate(frames):
+        if frame.ndim == 2:
+            groups.setdefault(frame.shape, []).append(position)
+    for positions in groups.values():
+        members = [datasets[frames[position][0]] for position in positions]
+        slopes = np.array([_first_float(ds, 'RescaleSlope', 1.0) for ds in members], dtype=np.float32)
+        intercepts = np.array([_first_float(ds, 'RescaleIntercept', 0.0) for ds in members], dtype=np.float32)
+        if window is not None:
+            centers = np.full(len(members), window[0], dtype=np.float32)
+            widths = np.full(len(members), window[1], dtype=np.float32)
+        else:
+            centers = np.array([_first_float(ds, 'WindowCenter', np.nan) for ds in members], dtype=np.float32)
+            widths = np.array([_first_float(ds, 'WindowWidth', np.nan) for ds in members], dtype=np.float32)
+        invert = np.array([ds.get('PhotometricInterpretation') == 'MONOCHROME1' for ds in members])
+        volume = np.stack([frames[position][2] for position in positions])
+        stack = window_stack(volume, slopes, intercepts, centers, widths, invert, value_range)
+        for position, display in zip(positions, stack):
+            displays[position] = display
+
+    os.makedirs(output_dir, exist_ok=True)
+    for position, (index, stem, frame) in enumerate(frames):
+        if index in errors:
+            continue
+        try:
+            output_paths = write_slice(frame, output_dir, stem, formats, png_compress_level, displays.get(position))
+            print(f"Extracted: {source_names[index]} -> {', '.join(output_paths)}")
+        except Exception as e:
+            print(f"Error writing {stem} from {source_names[index]}: {e}")
+            errors[index] = str(e)
+    return [(source_name, errors.get(index)) for index, source_name in enumerate(source_names)]
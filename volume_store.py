@@ -0,0 +1,408 @@
+import json
+import os
+
+import numpy as np
+
+from series_processor import series_value_range, stored_value_range, window_stack
+
+VOLUME_FILENAME = 'volume.raw'
+HEADER_FILENAME = 'volume.json'
+
+# Header elements a volume's layout is built from, read in the header-only pass
+VOLUME_TAGS = [
+    'SamplesPerPixel',
+    'BitsAllocated',
+    'PixelRepresentation',
+    'RescaleSlope',
+    'RescaleIntercept',
+    'WindowCenter',
+    'WindowWidth',
+    'PixelSpacing',
+    'SliceThickness',
+    'SpacingBetweenSlices',
+    'ImagePositionPatient',
+    'PhotometricInterpretation',
+    'BitsStored',
+    'SmallestPixelValueInSeries',
+    'LargestPixelValueInSeries',
+]
+
+# Reformatted planes: the axis of the (slices, rows, columns) volume they cut
+PLANES = {
+    'axial': 0,
+    'coronal': 1,
+    'sagittal': 2,
+}
+
+
+def _first(value):
+    if hasattr(value, '__len__') and not isinstance(value, (str, bytes)):
+        return value[0] if len(value) else None
+    return value
+
+
+def _float(value, default=None):
+    value = _first(value)
+    try:
+        return float(value) if value not in (None, '') else default
+    except (TypeError, ValueError):
+        return default
+
+
+def volume_fields(header):
+    """The layout-relevant header values of one instance, as plain JSON types."""
+    bits = header.get('BitsAllocated')
+    position = header.get('ImagePositionPatient')
+    pixel_spacing = header.get('PixelSpacing')
+    return {
+        'rows': int(header.Rows),
+        'columns': int(header.Columns),
+        'samples': int(header.get('SamplesPerPixel', 1) or 1),
+        'bits': int(bits) if bits not in (None, '') else None,
+        'signed': bool(header.get('PixelRepresentation', 0)),
+        'slope': _float(header.get('RescaleSlope'), 1.0),
+        'intercept': _float(header.get('RescaleIntercept'), 0.0),
+        'window': [_float(header.get('WindowCenter')), _float(header.get('WindowWidth'))],
+        'invert': header.get('PhotometricInterpretation') == 'MONOCHROME1',
+        'position': [float(v) for v in position] if position and len(position) == 3 else None,
+        'pixel_spacing': [float(v) for v in pixel_spacing] if pixel_spacing and len(pixel_spacing) == 2 else None,
+        'slice_thickness': _float(header.get('SliceThickness')),
+        'spacing_between_slices': _float(header.get('SpacingBetweenSlices')),
+        'value_range': stored_value_range(header),
+    }
+
+
+def _slice_spacing(entries):
+    positions = [entry['volume']['position'] for entry in entries]
+    if len(entries) > 1 and all(entry['frames'] == 1 for entry in entries) and None not in positions[:2]:
+        distance = float(np.linalg.norm(np.subtract(positions[1], positions[0])))
+        if distance > 0:
+            return distance
+    first = entries[0]['volume']
+    return first['spacing_between_slices'] or first['slice_thickness'] or 1.0
+
+
+def _stored_entries(folder, entries):
+    """
+    Pseudo manifest entries for the instances in the series' complete volume
+    that entries don't replace (by SOPInstanceUID, or by member name for
+    instances without one), so an upload of part of a series keeps the rest.
+    """
+    header = read_header(folder)
+    if header is None or header['status'] != 'complete':
+        return []
+    dtype = np.dtype(header['dtype'])
+    _, rows, columns = header['shape']
+    slice_spacing, row_spacing, column_spacing = header['spacing']
+    uids = {entry.get('sop_instance_uid') for entry in entries} - {None}
+    members = {entry['member'] for entry in entries}
+    missing = set(header['missing_slices'])
+    stored = []
+    for instance in header['instances']:
+        uid = instance.get('sop_instance_uid')
+        if uid in uids or (uid is None and instance['member'] in members):
+            continue
+        first_slice = instance['first_slice']
+        stored.append({
+            'member': instance['member'],
+            'sop_instance_uid': uid,
+            'instance_number': instance['instance_number'],
+            'frames': instance['frames'],
+            'stored_slice': first_slice,
+            'missing': [index - first_slice for index in range(first_slice, first_slice + instance['frames'])
+                        if index in missing],
+            'volume': {
+                'rows': rows,
+                'columns': columns,
+                'samples': 1,
+                'bits': dtype.itemsize * 8,
+                'signed': dtype.kind == 'i',
+                'slope': instance['slope'],
+                'intercept': instance['intercept'],
+                'window': instance['window'],
+                'invert': instance['invert'],
+                'position': instance.get('position'),
+                'pixel_spacing': [row_spacing, column_spacing],
+                'slice_thickness': None,
+                'spacing_between_slices': slice_spacing,
+                'value_range': header.get('value_range'),
+            },
+        })
+    return stored
+
+
+def create_volume(folder, entries, value_range=None):
+    """
+    Allocates the memory-mapped volume of a series and writes its header.
+
+    Instances already in the series' volume that this upload doesn't
+    replace are kept: their slices are copied into the new volume, so a
+    series sent in several uploads ends up in one volume. The new volume is
+    written beside the old one and moved into place, so readers that have
+    the old one mapped keep reading it.
+
+    Args:
+        folder (str): The series folder.
+        entries (list): The series' manifest entries in Instance Number
+            order, each with its 'volume' fields (see volume_fields).
+        value_range (tuple): Measured modality range of the windowless
+            slices of entries, see series_processor.unwindowed_value_range.
+
+    Returns:
+        dict: The layout workers write into: 'path', 'shape', 'dtype' and
+        the first slice of each member of entries ('starts'), plus the
+        'value_range' of the whole volume, or None if the series cannot
+        be stacked (color, mixed sizes or pixel formats).
+    """
+    stored = _stored_entries(folder, entries)
+    merged = sorted(entries + stored,
+                    key=lambda entry: (entry['instance_number'] is None, entry['instance_number'] or 0, entry['member']))
+    fields = [entry.get('volume') for entry in merged]
+    layout_keys = ('rows', 'columns', 'samples', 'bits', 'signed')
+    if not fields or None in fields or fields[0]['samples'] != 1 or fields[0]['bits'] not in (8, 16, 32) or \
+            any(tuple(f[key] for key in layout_keys) != tuple(fields[0][key] for key in layout_keys) for f in fields):
+        # Don't leave the volume of an earlier upload of this series behind
+        remove_volume(folder)
+        return None
+    first = fields[0]
+
+    dtype = np.dtype(f"{'int' if first['signed'] else 'uint'}{first['bits']}")
+    starts, instances, copies, missing, index = {}, [], [], [], 0
+    for entry, f in zip(merged, fields):
+        if 'stored_slice' in entry:
+            copies.append((entry['stored_slice'], index, entry['frames']))
+            missing.extend(index + frame for frame in entry['missing'])
+        else:
+            starts[entry['member']] = index
+        instances.append({
+            'member': entry['member'],
+            'sop_instance_uid': entry.get('sop_instance_uid'),
+            'instance_number': entry['instance_number'],
+            'first_slice': index,
+            'frames': entry['frames'],
+            'slope': f['slope'],
+            'intercept': f['intercept'],
+            'window': f['window'],
+            'invert': f['invert'],
+            'position': f['position'],
+        })
+        index += entry['frames']
+    shape = (index, first['rows'], first['columns'])
+    row_spacing, column_spacing = first['pixel_spacing'] or (1.0, 1.0)
+    if value_range is not None:
+        # Kept instances were windowed to the range recorded with them
+        value_range = series_value_range([value_range] + [entry['volume']['value_range'] for entry in stored])
+    else:
+        value_range = series_value_range(f['value_range'] for f in fields)
+
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, VOLUME_FILENAME)
+    # Sparse on most filesystems: slices take space as workers write them
+    with open(f"{path}.tmp", 'wb') as f:
+        f.truncate(int(np.prod(shape)) * dtype.itemsize)
+    if copies:
+        header = read_header(folder)
+        old = np.memmap(path, dtype=np.dtype(header['dtype']), mode='r', shape=tuple(header['shape']))
+        new = np.memmap(f"{path}.tmp", dtype=dtype, mode='r+', shape=shape)
+        try:
+            for source, target, frames in copies:
+                new[target:target + frames] = old[source:source + frames]
+            new.flush()
+        finally:
+            del old, new
+    os.replace(f"{path}.tmp", path)
+    _write_header(folder, {
+        'shape': list(shape),
+        'dtype': dtype.str,
+        'spacing': [_slice_spacing(merged), row_spacing, column_spacing],
+        'value_range': value_range,
+        'status': 'writing',
+        'missing_slices': missing,
+        'instances': instances,
+    })
+    return {'path': path, 'shape': shape, 'dtype': dtype.str, 'starts': starts,
+            'frames': {entry['member']: entry['frames'] for entry in entries}, 'existing': False,
+            'value_range': value_range}
+
+
+def reuse_volume(folder, entries):
+    """
+    The layout of a series' complete volume, if it already holds every
+    instance of entries (matched by SOPInstanceUID), so a re-sent series
+    only needs its changed instances written. None otherwise.
+    """
+    header = read_header(folder)
+    if header is None or header['status'] != 'complete':
+        return None
+    slices = {instance.get('sop_instance_uid'): instance for instance in header['instances']}
+    starts = {}
+    for entry in entries:
+        instance = slices.get(entry.get('sop_instance_uid')) if entry.get('sop_instance_uid') else None
+        if instance is None or instance['frames'] != entry['frames']:
+            return None
+        starts[entry['member']] = instance['first_slice']
+    return {'path': os.path.join(folder, VOLUME_FILENAME), 'shape': tuple(header['shape']), 'dtype': header['dtype'],
+            'starts': starts, 'frames': {entry['member']: entry['frames'] for entry in entries}, 'existing': True,
+            'value_range': header.get('value_range')}
+
+
+def _write_header(folder, header):
+    path = os.path.join(folder, HEADER_FILENAME)
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+        json.dump(header, f, indent=1)
+    os.replace(f"{path}.tmp", path)
+
+
+def remove_volume(folder):
+    for filename in (HEADER_FILENAME, VOLUME_FILENAME):
+        try:
+            os.remove(os.path.join(folder, filename))
+        except FileNotFoundError:
+            pass
+
+
+def write_frames(layout, stacks):
+    """
+    Copies frame stacks into the volume in place. Runs in pool workers, each
+    writing its own slab of slices.
+
+    Args:
+        layout (dict): As returned by create_volume.
+        stacks (list): (first slice, frames) pairs, frames being a
+            (frames, rows, columns) array.
+    """
+    volume = np.memmap(layout['path'], dtype=np.dtype(layout['dtype']), mode='r+', shape=tuple(layout['shape']))
+    try:
+        for start, frames in stacks:
+            volume[start:start + len(frames)] = frames
+        volume.flush()
+    finally:
+        del volume
+
+
+def finish_volume(folder, layout, results):
+    """
+    Marks a series volume complete once its members are done, updating the
+    list of slices missing from it.
+
+    Args:
+        folder (str): The series folder.
+        layout (dict): As returned by create_volume or reuse_volume.
+        results (list): Per-member results with 'member' and 'in_volume'.
+    """
+    header = read_header(folder)
+    if header is None:
+        return
+    written, failed = set(), set()
+    for member_result in results:
+        start = layout['starts'][member_result['member']]
+        frames = range(start, start + layout['frames'][member_result['member']])
+        (written if member_result['in_volume'] else failed).update(frames)
+    header['missing_slices'] = sorted((set(header['missing_slices']) - written) | failed)
+    header['status'] = 'complete'
+    _write_header(folder, header)
+
+
+def read_header(folder):
+    try:
+        with open(os.path.join(folder, HEADER_FILENAME), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class SeriesVolume:
+    """
+    Read-only view of a series volume. Slices, slabs and planes are numpy
+    views onto the memory map: nothing is read from disk until used, and
+    nothing is decoded.
+
+    Raises:
+        FileNotFoundError: If the folder has no volume.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.header = read_header(folder)
+        if self.header is None:
+            raise FileNotFoundError(f"No volume in {folder}")
+        self.shape = tuple(self.header['shape'])
+        self.spacing = tuple(self.header['spacing'])
+        self.array = np.memmap(os.path.join(folder, VOLUME_FILENAME), dtype=np.dtype(self.header['dtype']),
+                               mode='r', shape=self.shape)
+        # Per-slice display parameters, as series_processor.window_stack takes them
+        slices = self.shape[0]
+        self.slopes = np.ones(slices, dtype=np.float32)
+        self.intercepts = np.zeros(slices, dtype=np.float32)
+        self.centers = np.full(slices, np.nan, dtype=np.float32)
+        self.widths = np.full(slices, np.nan, dtype=np.float32)
+        self.invert = np.zeros(slices, dtype=bool)
+        for instance in self.header['instances']:
+            frames = slice(instance['first_slice'], instance['first_slice'] + instance['frames'])
+            self.slopes[frames] = instance['slope']
+            self.intercepts[frames] = instance['intercept']
+            center, width = instance['window']
+            if center is not None and width:
+                self.centers[frames], self.widths[frames] = center, width
+            self.invert[frames] = instance['invert']
+
+    def slice(self, index):
+        return self.plane('axial', index)
+
+    def slab(self, start, stop):
+        if not 0 <= start < stop <= self.shape[0]:
+            raise IndexError(f"Slab {start}:{stop} is outside 0:{self.shape[0]}")
+        return self.array[start:stop]
+
+    def plane(self, name, index):
+        """
+        An axial (rows x columns), coronal (slices x columns) or sagittal
+        (slices x rows) plane of stored values.
+
+        Raises:
+            KeyError: For an unknown plane.
+            IndexError: If index is out of range.
+        """
+        axis = PLANES[name]
+        if not 0 <= index < self.shape[axis]:
+            raise IndexError(f"{name.capitalize()} plane {index} is outside 0:{self.shape[axis]}")
+        return np.take(self.array, index, axis=axis) if axis else self.array[index]
+
+    def display(self, name, index, window=None):
+        """
+        A plane rescaled and windowed to 8-bit, the same way extraction
+        windows slices.
+
+        Args:
+            name (str): 'axial', 'coronal' or 'sagittal'.
+            index (int): Position of the plane along its axis.
+            window (tuple): (center, width), or None for each slice's own.
+
+        Returns:
+            numpy.ndarray: The 8-bit plane.
+        """
+        plane = self.plane(name, index)
+        if PLANES[name] == 0:
+            # One slice: a stack of one
+            rows, stack = slice(index, index + 1), plane[np.newaxis]
+        else:
+            # Each row of a reformatted plane comes from one slice
+            rows, stack = slice(None), plane[:, np.newaxis, :]
+        count = len(stack)
+        if window is not None:
+            centers = np.full(count, window[0], dtype=np.float32)
+            widths = np.full(count, window[1], dtype=np.float32)
+        else:
+            centers, widths = self.centers[rows], self.widths[rows]
+        display = window_stack(stack, self.slopes[rows], self.intercepts[rows], centers, widths, self.invert[rows],
+                               self.header.get('value_range'))
+        return display[0] if PLANES[name] == 0 else display[:, 0, :]
+
+    def aspect(self, name):
+        """Height and width of one pixel of a plane, in mm."""
+        slice_spacing, row_spacing, column_spacing = self.spacing
+        return {
+            'axial': (row_spacing, column_spacing),
+            'coronal': (slice_spacing, column_spacing),
+            'sagittal': (slice_spacing, row_spacing),
+        }[name]